@@ -0,0 +1,164 @@
+#!/usr/bin/env -S python3 -O
+"""
+Worker mode: serve completion jobs from RabbitMQ instead of HTTP.
+
+Jobs are published to the topic exchange `openai_session_jobs` with the routing key
+`openai_session_jobs.<partition>`, where the partition is `job_partition(sid, partitions)`.
+A worker owns a fixed set of partitions and keeps the sessions of those partitions in
+its own data folder. New sessions get an id in the partition the job was routed to,
+and replies created by a worker stay in the partition of their parent, so one session
+tree is always served by the same node.
+
+Job body (JSON): the fields of `/api` (`sid`, `msg`, `model`, `system_msg`, `user_name`,
+`assistant_name`, `timeout`). The reply is published to the `reply_to` queue of the
+job with the same `correlation_id`, its body is the JSON returned by `/api`, or
+`{"error": ..., "status": ...}`.
+
+    docker run -d --rm -p 5672:5672 rabbitmq:3
+    OPENAI_DATA_FOLDER=./data OPENAI_WORKER_PARTITIONS=0-15 python amqp_worker.py
+"""
+import json
+import os
+import random
+import sys
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Tuple
+
+import openai
+
+from deadline import Deadline, RequestCancelled, RequestShed
+from model_wrap import model_string_to_model
+from openai_session import SessionKeeper
+from openai_session_logging import ERROR, WARNING, log
+from partitioning import jump_hash, parse_partitions
+
+if TYPE_CHECKING:
+    from pika import BasicProperties
+    from pika.spec import Basic
+
+JOB_EXCHANGE = "openai_session_jobs"
+PARTITION_COUNT_DEFAULT = 16
+
+
+def job_partition(sid: int | None, partitions: int) -> int:
+    """
+    Partition of a job. Jobs creating a new session may go to any partition.
+    """
+    if sid is None:
+        return random.randrange(partitions)
+    return jump_hash(sid, partitions)
+
+
+def job_routing_key(sid: int | None, partitions: int) -> str:
+    return f"{JOB_EXCHANGE}.{job_partition(sid, partitions)}"
+
+
+class CompletionWorker(object):
+    def __init__(self, keeper: SessionKeeper, publisher: Any, default_model: str, default_system_msg: str) -> None:
+        self.keeper = keeper
+        self.publisher = publisher
+        self.default_model = default_model
+        self.default_system_msg = default_system_msg
+
+    def handle(self, routing_key: str, body: bytes, deliver: "Basic.Deliver", properties: "BasicProperties") -> None:
+        partition = int(routing_key.rsplit(".", 1)[1])
+        try:
+            ret, status = self._run(json.loads(body), partition)
+        except Exception as e:
+            log(repr(e), level=ERROR)
+            ret, status = {"error": repr(e)}, 400
+        if status != 200:
+            ret["status"] = status
+        if not properties.reply_to:
+            return
+        from pika import BasicProperties
+        self.publisher.publish(
+            properties.reply_to,
+            json.dumps(ret, ensure_ascii=False),
+            exchange="",
+            properties=BasicProperties(correlation_id=properties.correlation_id, content_type="application/json"),
+            block=True,
+        )
+
+    def _run(self, data: Dict[str, Any], partition: int) -> Tuple[Dict[str, Any], int]:
+        if not isinstance(data, dict) or "msg" not in data:
+            return {"error": "No message provided"}, 400
+        sid_raw = data.get("sid")
+        sid = int(sid_raw) if sid_raw else None
+        msg = data["msg"]
+        system_msg = data.get("system_msg")
+        user_name = data.get("user_name")
+        assistant_name = data.get("assistant_name")
+        if sid is not None and any(x is not None for x in (system_msg, user_name, assistant_name)):
+            return {"error": "Cannot specify system_msg, user_name or assistant_name for an existing session"}, 400
+        if sid is None and system_msg is None:
+            system_msg = self.default_system_msg
+        if not all(x is None or isinstance(x, str) for x in (msg, system_msg, user_name, assistant_name)):
+            return {"error": "msg, system_msg, user_name, assistant_name must be strings"}, 400
+        if sid is not None and self.keeper.partition_of(sid) != partition:
+            return {"error": f"sid {sid} does not belong to partition {partition}"}, 400
+        model = model_string_to_model(str(data.get("model", self.default_model)))
+        timeout = data.get("timeout")
+        deadline = Deadline(float(timeout)) if timeout is not None else None
+        try:
+            response = self.keeper.call(sid, msg, model, system_msg, user_name, assistant_name, deadline, partition)
+        except openai.RateLimitError:
+            log("Token rate limit exceeded!", level=WARNING)
+            return {"error": "Token rate limit exceeded"}, 503
+        except RequestShed as e:
+            return {"error": str(e)}, 503
+        except RequestCancelled as e:
+            ret: Dict[str, Any] = {"error": str(e)}
+            if e.new_session_id is not None:
+                ret["text"] = e.partial.content
+                ret["new_session_id"] = e.new_session_id
+            return ret, 504
+        return response.as_dict(), 200
+
+
+def main() -> None:
+    import main as server
+    import pika_interface_blocking
+
+    data_directory = os.environ.get("OPENAI_DATA_FOLDER")
+    if data_directory is None:
+        print("environment variable OPENAI_DATA_FOLDER not set", file=sys.stderr)
+        exit(1)
+    if not os.path.exists(data_directory):
+        os.makedirs(data_directory)
+    partition_count = int(os.environ.get("OPENAI_WORKER_PARTITION_COUNT", PARTITION_COUNT_DEFAULT))
+    owned = parse_partitions(os.environ.get("OPENAI_WORKER_PARTITIONS", f"0-{partition_count - 1}"))
+    if not owned or any(p < 0 or p >= partition_count for p in owned):
+        print(f"OPENAI_WORKER_PARTITIONS must be within 0-{partition_count - 1}", file=sys.stderr)
+        exit(1)
+    threads = int(os.environ.get("OPENAI_WORKER_THREADS", "8"))
+    prefetch = int(os.environ.get("OPENAI_WORKER_PREFETCH", str(threads)))
+
+    _use_model_name = os.environ.get("OPENAI_DEFAULT_MODEL_STRING")
+    if _use_model_name is not None:
+        server.set_default_model(_use_model_name)
+
+    keeper = SessionKeeper(
+        data_directory,
+        persist_partial=bool(os.environ.get("OPENAI_PERSIST_PARTIAL")),
+        partitions=partition_count,
+    )
+    publisher = pika_interface_blocking.PikaPublisher().start()
+    worker = CompletionWorker(keeper, publisher, server.DEFAULT_MODEL, server.SYSTEM_MSG_DEFAULT)
+    bindings = {f"{JOB_EXCHANGE}.{p}": f"{JOB_EXCHANGE}.{p}" for p in owned}
+    consumer = pika_interface_blocking.listen_to(
+        JOB_EXCHANGE, bindings, worker.handle,
+        logging_interface_obj=pika_interface_blocking.NoLogInterface(),
+        prefetch_count=prefetch,
+        workers=threads,
+    )
+    log(f"Worker serving partitions {owned} of {partition_count}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        consumer.stop()
+        publisher.stop()
+
+
+if __name__ == "__main__":
+    main()
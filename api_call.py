@@ -8,14 +8,32 @@ from openai.types.chat import (
     ChatCompletionSystemMessageParam,
 )
 
-from model_wrap import DEEPSEEK_R1, MODEL_DICT, O1, O3_MINI, ModelWrapper
+from deadline import Deadline, RequestCancelled
+from key_pool import ClientPool, KeyState
+from metrics import UPSTREAM_TOKENS_PER_SECOND, UPSTREAM_TTFT_SECONDS
+from model_wrap import DEEPSEEK_R1, MODEL_DICT, O1, O3_MINI, ModelWrapper, model_provider
 from openai_session_logging import log
+from tracing import span
 
-OPENAI_CLIENT = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
-DEEPSEEK_CLIENT = openai.OpenAI(
-    base_url="https://api.deepseek.com/v1",
-    api_key=os.environ.get("DEEPSEEK_API_KEY"),
+def _stream_usage(base_url_env: str) -> bool:
+    """
+    Whether to request the final usage chunk with `stream_options`. Both providers accept it
+    on their own endpoints, a custom base URL may point to a server rejecting unknown options.
+    """
+    forced = os.environ.get("OPENAI_STREAM_USAGE")
+    if forced is not None:
+        return forced != "0"
+    return not os.environ.get(base_url_env)
+
+
+OPENAI_CLIENT = ClientPool.from_env("openai", "OPENAI_API_KEY", stream_usage=_stream_usage("OPENAI_BASE_URL"))
+
+DEEPSEEK_CLIENT = ClientPool.from_env(
+    "deepseek",
+    "DEEPSEEK_API_KEY",
+    base_url=os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
+    stream_usage=_stream_usage("DEEPSEEK_BASE_URL"),
 )
 
 
@@ -36,11 +54,48 @@ class CompletionAPIResponse(ObjectDict):
     role: str
     content: str
     reasoning_content: str
+    cached_tokens: int | None
+
+
+def _open_stream(pool: ClientPool, deadline: Deadline | None, **kw) -> tuple[KeyState, Any]:
+    """
+    Start a streaming completion with the best key of the pool, moving on
+    to the next key if the chosen one gets quarantined.
+    The returned key must be released by the caller.
+    """
+    tried: list[KeyState] = []
+    while True:
+        key = pool.acquire(tried)
+        client = key.client
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if remaining is not None:
+                kw["timeout"] = remaining
+                # retries would silently outlive the deadline
+                client = client.with_options(max_retries=0)
+        try:
+            raw = client.chat.completions.with_raw_response.create(stream=True, **kw)
+        except openai.APIStatusError as e:
+            pool.release(key)
+            if not pool.record_error(key, e) or len(tried) + 1 >= len(pool):
+                raise
+            tried.append(key)
+            continue
+        except BaseException:
+            pool.release(key)
+            raise
+        pool.update_from_headers(key, raw.headers)
+        return key, raw.parse()
 
 
 def completion_api_call(
-    system_msg: str, messages: Iterable[ChatCompletionMessageParam], model: ModelWrapper
+    system_msg: str,
+    messages: Iterable[ChatCompletionMessageParam],
+    model: ModelWrapper,
+    deadline: Deadline | None = None,
+    cache_key: str | None = None,
 ):
+    kw: dict[str, Any] = dict()
     messages_send = [
         cast(
             ChatCompletionSystemMessageParam, {"role": "system", "content": system_msg}
@@ -48,33 +103,84 @@ def completion_api_call(
     ] + list(messages)
     model_str = str(model)
     if model_str == MODEL_DICT[DEEPSEEK_R1]:
-        client = DEEPSEEK_CLIENT
+        pool = DEEPSEEK_CLIENT
         print("Using DeepSeek")
     else:
-        client = OPENAI_CLIENT
+        pool = OPENAI_CLIENT
+        if cache_key is not None:
+            kw["extra_body"] = {"prompt_cache_key": cache_key}
     # call
     log(f"API call received, model={model_str}")
     _t0 = perf_counter()
-    kw: dict[str, Any] = dict()
     if model_str == MODEL_DICT[O1] or model_str == MODEL_DICT[O3_MINI]:
         kw["reasoning_effort"] = "high"
-    responseObj = client.chat.completions.create(
-        model=model_str, messages=messages_send, stream=True, **kw
-    )
+    if pool.stream_usage:
+        kw["stream_options"] = {"include_usage": True}
+    if deadline is not None:
+        deadline.check()
     content = ""
     _reasoning_content = ""
     role = ""
-    for chunk in responseObj:
-        cur_delta = chunk.choices[0].delta
-        if not role:
-            role = cur_delta.role
-        content += cur_delta.content if cur_delta.content else ""
-        cur_reasoning_content = getattr(cur_delta, "reasoning_content", None)
-        _reasoning_content += cur_reasoning_content if cur_reasoning_content else ""
+    cached_tokens = None
+    completion_tokens = None
+    _t_first = None
+
+    def _partial():
+        return CompletionAPIResponse(
+            role=role, content=content, reasoning_content=_reasoning_content or None
+        )
+    key = None
+    responseObj = None
+    try:
+        with span("upstream_connect"):
+            key, responseObj = _open_stream(
+                pool, deadline, model=model_str, messages=messages_send, **kw
+            )
+        with span("upstream_stream"):
+            for chunk in responseObj:
+                if chunk.usage is not None:
+                    pool.record_usage(key, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                    completion_tokens = chunk.usage.completion_tokens
+                    details = getattr(chunk.usage, "prompt_tokens_details", None)
+                    cached_tokens = getattr(details, "cached_tokens", None)
+                    if cached_tokens is None:
+                        # DeepSeek reports cache hits on its own field
+                        cached_tokens = getattr(chunk.usage, "prompt_cache_hit_tokens", None)
+                if not chunk.choices:
+                    # the usage chunk comes last with no choices
+                    continue
+                cur_delta = chunk.choices[0].delta
+                if not role:
+                    role = cur_delta.role
+                content += cur_delta.content if cur_delta.content else ""
+                cur_reasoning_content = getattr(cur_delta, "reasoning_content", None)
+                _reasoning_content += cur_reasoning_content if cur_reasoning_content else ""
+                if _t_first is None and (cur_delta.content or cur_reasoning_content):
+                    _t_first = perf_counter()
+                if deadline is not None:
+                    reason = deadline.cancel_reason()
+                    if reason is not None:
+                        raise RequestCancelled(reason, _partial())
+    except BaseException as e:
+        if responseObj is not None:
+            # stop paying for tokens nobody will read
+            responseObj.close()
+            log(f"API call aborted after {perf_counter() - _t0:.2f}s")
+        if deadline is not None and not isinstance(e, RequestCancelled) and deadline.expired():
+            raise RequestCancelled("deadline exceeded", _partial()) from e
+        raise
+    finally:
+        if key is not None:
+            pool.release(key)
     # response process done
     _t1 = perf_counter()
     log(f"Previous API call took {_t1 - _t0:.2f}s")
+    provider = model_provider(model.id)
+    if _t_first is not None:
+        UPSTREAM_TTFT_SECONDS.observe(_t_first - _t0, model_str, provider)
+        if completion_tokens and _t1 > _t_first:
+            UPSTREAM_TOKENS_PER_SECOND.observe(completion_tokens / (_t1 - _t_first), model_str, provider)
     reasoning_content = None if not _reasoning_content else _reasoning_content
     return CompletionAPIResponse(
-        role=role, content=content, reasoning_content=reasoning_content
+        role=role, content=content, reasoning_content=reasoning_content, cached_tokens=cached_tokens
     )
@@ -0,0 +1,81 @@
+"""
+Publish throughput against a local RabbitMQ, before and after PikaPublisher.
+
+    docker run -d --rm -p 5672:5672 rabbitmq:3
+    python benchmarks/bench_publisher.py -n 20000
+
+"before" is the historical path: a channel and an exchange declare for every
+message on the substained connection, one message at a time.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pika import BlockingConnection  # noqa: E402
+from pika.exchange_type import ExchangeType  # noqa: E402
+
+import pika_interface_blocking  # noqa: E402
+
+_ROUTING_KEY = "bench.publisher"
+
+
+def bench_before(n: int, body: str) -> float:
+    connection = BlockingConnection()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        channel = connection.channel()
+        channel.exchange_declare(exchange="bench", exchange_type=ExchangeType.topic)
+        channel.basic_publish(exchange="bench", routing_key=_ROUTING_KEY, body=body)
+        # the old path never closed them, which runs into channel_max on long runs
+        channel.close()
+    connection.process_data_events(0)
+    t1 = time.perf_counter()
+    connection.close()
+    return t1 - t0
+
+
+def bench_send_message(n: int, body: str) -> float:
+    connection = BlockingConnection()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        pika_interface_blocking.send_message(_ROUTING_KEY, body, connection)
+    connection.process_data_events(0)
+    t1 = time.perf_counter()
+    connection.close()
+    return t1 - t0
+
+
+def bench_publisher(n: int, body: str, batch_size: int, confirm: bool) -> float:
+    publisher = pika_interface_blocking.PikaPublisher(max_buffer=n + 1, batch_size=batch_size, confirm=confirm).start()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        publisher.publish(_ROUTING_KEY, body, block=True)
+    publisher.flush(timeout=600.)
+    t1 = time.perf_counter()
+    publisher.stop()
+    return t1 - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20000, help="messages per run")
+    parser.add_argument("--size", type=int, default=256, help="message size in bytes")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    body = "x" * args.size
+    runs = [
+        ("before: channel + declare per message", lambda: bench_before(args.n, body)),
+        ("send_message with cached channel", lambda: bench_send_message(args.n, body)),
+        ("PikaPublisher", lambda: bench_publisher(args.n, body, args.batch_size, False)),
+        ("PikaPublisher, batch confirm", lambda: bench_publisher(args.n, body, args.batch_size, True)),
+    ]
+    for name, run in runs:
+        elapsed = run()
+        print(f"{name:40s} {args.n / elapsed:12.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Micro-benchmarks of the session core on generated session trees, no network.
+
+    python benchmarks/bench_session_core.py --depth 200 --breadth 4 --msg-chars 400 --save core.json
+    python benchmarks/bench_session_core.py --depth 200 --breadth 4 --msg-chars 400 --baseline core.json
+
+A tree is a root with `breadth` branches of `depth` nodes each. Results are the
+median and minimum seconds per call over `--repeat` runs. With `--baseline`, the
+medians are compared against a saved run and the script exits with status 1 if
+a benchmark got slower by more than `--tolerance`.
+
+Token counting needs the tiktoken encodings: on a box without network, set
+`TIKTOKEN_CACHE_DIR` to a cache populated beforehand.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from model_wrap import model_string_to_model  # noqa: E402
+from openai_session import OpenAISession, SessionData, SessionKeeper  # noqa: E402
+
+_WORDS = ("alpha", "beta", "gamma", "delta", "session", "token", "stream", "cache", "history", "model")
+
+
+def _text(chars: int, rng: random.Random) -> str:
+    words = []
+    n = 0
+    while n < chars:
+        w = rng.choice(_WORDS)
+        words.append(w)
+        n += len(w) + 1
+    return " ".join(words)[:chars]
+
+
+def generate_tree(directory: str, depth: int, breadth: int, msg_chars: int, seed: int = 0) -> None:
+    """
+    Write `s_*.json` files of one root with `breadth` branches of `depth` nodes.
+    """
+    rng = random.Random(seed)
+    sid = 1
+    nodes = [SessionData(sid, _text(msg_chars, rng), None, _text(msg_chars, rng), _text(msg_chars, rng), None, None, None, None, None, None)]
+    for _ in range(breadth):
+        previous = 1
+        for _ in range(depth):
+            sid += 1
+            nodes.append(SessionData(sid, None, previous, _text(msg_chars, rng), _text(msg_chars, rng), None, None, None, None, None, None))
+            previous = sid
+    for data in nodes:
+        with open(os.path.join(directory, f"s_{data.id}.json"), "w", encoding="utf-8") as f:
+            f.write(data.serialize())
+
+
+def measure(f: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    # pick a loop count so that one run lasts about 20ms
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            f()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= 0.02 or loops >= 1 << 20:
+            break
+        loops *= 2
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            f()
+        runs.append((time.perf_counter() - t0) / loops)
+    return {"median": statistics.median(runs), "min": min(runs), "loops": loops}
+
+
+def run(depth: int, breadth: int, msg_chars: int, model_name: str, repeat: int) -> Dict[str, Any]:
+    model = model_string_to_model(model_name)
+    with tempfile.TemporaryDirectory(prefix="openai_session_bench_") as directory:
+        generate_tree(directory, depth, breadth, msg_chars)
+        keeper = SessionKeeper(directory)
+        leaf: OpenAISession = keeper.get(1 + breadth * depth)
+        chain = leaf.get_chain()
+        history = OpenAISession.parse_history(chain)
+        sys_msg = chain[0].data.system_msg
+        assert sys_msg is not None
+        serialized = leaf.data.serialize()
+        message = history[-1]["content"]
+        # load the encoding before timing
+        OpenAISession._count_token_for(model, message)
+        benchmarks: Dict[str, Callable[[], Any]] = {
+            "get_chain": leaf.get_chain,
+            "parse_history": lambda: OpenAISession.parse_history(chain),
+            "calculate_propriate_cut_index": lambda: leaf._calculate_propriate_cut_index(sys_msg, history, model),
+            "count_token_for": lambda: OpenAISession._count_token_for(model, message),
+            "serialize": leaf.data.serialize,
+            "deserialize": lambda: SessionData.deserialize(io.StringIO(serialized)),
+            "keeper_load": lambda: SessionKeeper(directory),
+        }
+        results = {}
+        for name, f in benchmarks.items():
+            results[name] = measure(f, repeat if name != "keeper_load" else max(3, repeat // 4))
+            print(f"{name:32s} {results[name]['median'] * 1e6:14.2f} us")
+    return {
+        "params": {"depth": depth, "breadth": breadth, "msg_chars": msg_chars, "model": model_name},
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """
+    Print the ratio of current to baseline medians, return False on a regression.
+    """
+    if current["params"] != baseline["params"]:
+        print(f"warning: parameters differ from the baseline: {baseline['params']}")
+    ok = True
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["median"] / base["median"]
+        regressed = ratio > 1 + tolerance
+        ok = ok and not regressed
+        print(f"{name:32s} {ratio:8.3f}x{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=100, help="nodes per branch")
+    parser.add_argument("--breadth", type=int, default=4, help="branches under the root")
+    parser.add_argument("--msg-chars", type=int, default=400, help="characters per message")
+    parser.add_argument("--model", default="GPT4O_MINI")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="compare against a saved JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+    current = run(args.depth, args.breadth, args.msg_chars, args.model, args.repeat)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(current, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+A local stand-in for the OpenAI-compatible streaming chat completions API.
+
+    python benchmarks/fake_upstream.py --port 18080 --ttft 0.3 --tps 50 --error-rate 0.01
+
+Point the server at it with `OPENAI_BASE_URL=http://127.0.0.1:18080/v1` and
+`DEEPSEEK_BASE_URL=http://127.0.0.1:18080/v1`. Any API key is accepted.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+
+class FakeUpstreamConfig(object):
+    def __init__(self, ttft: float = 0.3, tps: float = 50., output_tokens: int = 50,
+                 error_rate: float = 0., rate_limit_rate: float = 0.) -> None:
+        self.ttft = ttft
+        self.tps = tps
+        self.output_tokens = output_tokens
+        # fraction of requests failing with 500 and 429
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+
+def _chunk(model: str, created: int, delta: Dict[str, Any], usage: Dict[str, int] | None = None) -> bytes:
+    o: Dict[str, Any] = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": None}] if usage is None else [],
+    }
+    if usage is not None:
+        o["usage"] = usage
+    return f"data: {json.dumps(o)}\n\n".encode()
+
+
+def make_handler(config: FakeUpstreamConfig):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            ...
+
+        def _error(self, status: int, code: str, message: str) -> None:
+            body = json.dumps({"error": {"message": message, "type": code, "code": code}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 429:
+                self.send_header("retry-after", "0.1")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if not self.path.endswith("/models"):
+                self._error(404, "not_found", f"Unknown path {self.path}")
+                return
+            body = json.dumps({"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self._error(404, "not_found", f"Unknown path {self.path}")
+                return
+            r = random.random()
+            if r < config.rate_limit_rate:
+                self._error(429, "rate_limit_exceeded", "Rate limit reached")
+                return
+            if r < config.rate_limit_rate + config.error_rate:
+                self._error(500, "server_error", "Injected failure")
+                return
+            model = request.get("model", "fake")
+            prompt_tokens = sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4
+            created = int(time.time())
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            try:
+                time.sleep(config.ttft)
+                self.wfile.write(_chunk(model, created, {"role": "assistant", "content": ""}))
+                for i in range(config.output_tokens):
+                    self.wfile.write(_chunk(model, created, {"content": f"tok{i} "}))
+                    self.wfile.flush()
+                    if config.tps > 0:
+                        time.sleep(1. / config.tps)
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": config.output_tokens,
+                    "total_tokens": prompt_tokens + config.output_tokens,
+                }
+                self.wfile.write(_chunk(model, created, {}, usage))
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # the client cancelled the stream
+                ...
+
+    return Handler
+
+
+def serve(config: FakeUpstreamConfig, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the fake upstream in a daemon thread, `server.server_address` has the bound port.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-upstream", daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tps", type=float, default=50., help="output tokens per second, 0 for no delay")
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0., help="fraction of requests failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0., help="fraction of requests failing with 429")
+
+
+def config_from_args(args) -> FakeUpstreamConfig:
+    return FakeUpstreamConfig(args.ttft, args.tps, args.output_tokens, args.error_rate, args.rate_limit_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(config_from_args(args), args.port)
+    print(f"Fake upstream on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Load test of the server against a local fake upstream, runs offline.
+
+    python benchmarks/load_test.py --concurrency 16 --conversations 200 --depth 5
+
+Starts `fake_upstream` in-process and `main.py` as a subprocess pointed at it,
+drives `/api` with concurrent conversations (a root call, then `depth - 1`
+follow-ups) and reports throughput, latency percentiles and the server CPU time
+per request. With `--url`, an already running server is used instead (pass
+`--pid` to also measure its CPU).
+
+Token counting needs the tiktoken encodings: on a box without network, set
+`TIKTOKEN_CACHE_DIR` to a cache populated beforehand.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_upstream  # noqa: E402
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+_WORDS = ("alpha", "beta", "gamma", "delta", "session", "token", "stream", "cache", "history", "model")
+# no proxy for local traffic
+_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _message(words: int) -> str:
+    return " ".join(random.choice(_WORDS) for _ in range(words))
+
+
+def post(url: str, body: Dict[str, Any], timeout: float = 600.) -> tuple[int, Any, float]:
+    """
+    POST JSON, return the status, the decoded body and the latency.
+    """
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    t0 = time.perf_counter()
+    try:
+        with _OPENER.open(request, timeout=timeout) as response:
+            status, raw = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, raw = e.code, e.read()
+    latency = time.perf_counter() - t0
+    try:
+        return status, json.loads(raw), latency
+    except ValueError:
+        return status, raw.decode(errors="replace"), latency
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime, fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    # nearest rank
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results: List[tuple[str, int, float]], elapsed: float) -> Dict[str, Any]:
+    ret: Dict[str, Any] = {"requests": len(results), "elapsed": round(elapsed, 3),
+                           "throughput": round(len(results) / elapsed, 3) if elapsed else None}
+    for kind in sorted({r[0] for r in results}) + ["all"]:
+        rows = [r for r in results if kind == "all" or r[0] == kind]
+        latencies = [r[2] for r in rows if r[1] == 200]
+        ret[kind] = {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if r[1] != 200),
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+        }
+    return ret
+
+
+def start_server(upstream_url: str, data_directory: str, extra_env: Dict[str, str]) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_BASE_URL": upstream_url,
+        "DEEPSEEK_BASE_URL": upstream_url,
+        "OPENAI_API_KEY": "sk-fake",
+        "DEEPSEEK_API_KEY": "sk-fake",
+        # the fake upstream accepts stream_options like the real providers
+        "OPENAI_STREAM_USAGE": "1",
+        # main.py insists on proxy variables, empty ones are ignored by the clients
+        "http_proxy": "",
+        "https_proxy": "",
+        "no_proxy": "127.0.0.1,localhost",
+        "OPENAI_DATA_FOLDER": data_directory,
+        "OPENAI_PORT": str(port),
+    })
+    env.update(extra_env)
+    log_path = os.path.join(data_directory, "server.log")
+    # the server keeps its own copy of the descriptor
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        process = subprocess.Popen([sys.executable, "main.py"], cwd=_ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    end = time.monotonic() + 60
+    while time.monotonic() < end:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}, see {log_path}")
+        try:
+            # 503 until the warmup is done
+            with _OPENER.open(f"{url}/ready", timeout=1):
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    process.wait()
+    raise RuntimeError(f"Server did not start in time, see {log_path}")
+
+
+def drive(url: str, conversations: int, concurrency: int, depth: int, msg_words: int,
+          model: str | None, timeout: float) -> tuple[List[tuple[str, int, float]], float]:
+    results: List[tuple[str, int, float]] = []
+    lock = threading.Lock()
+    remaining = [conversations]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            sid = None
+            for turn in range(depth):
+                body: Dict[str, Any] = {"msg": _message(msg_words)}
+                if sid is not None:
+                    body["sid"] = sid
+                if model is not None:
+                    body["model"] = model
+                status, response, latency = post(f"{url}/api", body, timeout)
+                with lock:
+                    results.append(("root" if turn == 0 else "turn", status, latency))
+                if status != 200:
+                    break
+                sid = response["new_session_id"]
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=5, help="calls per conversation")
+    parser.add_argument("--msg-words", type=int, default=50, help="words per user message")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--timeout", type=float, default=600.)
+    parser.add_argument("--url", default=None, help="use a running server instead of starting one")
+    parser.add_argument("--pid", type=int, default=None, help="pid of the server given by --url")
+    parser.add_argument("--server-env", action="append", default=[], help="KEY=VALUE for the started server")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    fake_upstream.add_arguments(parser)
+    args = parser.parse_args()
+
+    process = None
+    url, pid = args.url, args.pid
+    if url is None:
+        upstream = fake_upstream.serve(fake_upstream.config_from_args(args))
+        upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}/v1"
+        data_directory = tempfile.mkdtemp(prefix="openai_session_load_")
+        extra_env = dict(x.split("=", 1) for x in args.server_env)
+        process, url = start_server(upstream_url, data_directory, extra_env)
+        pid = process.pid
+        print(f"Server on {url}, data in {data_directory}")
+    try:
+        cpu0 = cpu_seconds(pid) if pid else None
+        results, elapsed = drive(url, args.conversations, args.concurrency, args.depth, args.msg_words,
+                                 args.model, args.timeout)
+        cpu1 = cpu_seconds(pid) if pid else None
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    report = summarize(results, elapsed)
+    if cpu0 is not None and cpu1 is not None and results:
+        report["server_cpu_ms_per_request"] = round((cpu1 - cpu0) * 1000 / len(results), 3)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Replay the traffic recorded in a data folder against a server on a fake upstream.
+
+    python benchmarks/replay.py /path/to/OPENAI_DATA_FOLDER --compression 60 --concurrency 16
+
+Every `s_*.json` node is one past `/api` call, classified as:
+
+* `root`: a new session, sent with its system message,
+* `turn`: the first answer to its parent,
+* `fork`: a later answer to a parent that already had one.
+
+Nodes do not store when they were created, so the file modification time is
+used, raised to the parent time where needed. Calls are sent at their recorded
+offsets divided by `--compression`, idle gaps are capped by `--max-gap`. A
+follow-up is sent on the sid its parent got during the replay, and skipped if
+the parent failed. The model is not recorded either, `--model` is used for all
+calls.
+
+The server and fake upstream are started as in `load_test.py`, which also
+takes the fake upstream options.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_upstream  # noqa: E402
+from load_test import post, start_server, summarize  # noqa: E402
+
+
+class ReplayCall(object):
+    def __init__(self, data: Dict[str, Any], at: float) -> None:
+        self.data = data
+        self.at = at
+        self.kind = "root"
+        self.parent: Optional["ReplayCall"] = None
+        self.depth = 0
+        # False when an ancestor file is missing
+        self.rooted = data["previous"] is None
+        self.new_session_id: Optional[int] = None
+        self.done = threading.Event()
+        self._placed = False
+
+
+def load_calls(directory: str) -> List[ReplayCall]:
+    """
+    Read the nodes of a data folder, return them as calls in replay order.
+    """
+    calls: Dict[int, ReplayCall] = {}
+    for x in os.listdir(directory):
+        if not (x.startswith("s_") and x.endswith(".json") and x[2:-5].isdigit()):
+            continue
+        path = os.path.join(directory, x)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        calls[data["id"]] = ReplayCall(data, os.path.getmtime(path))
+    children: Dict[int, List[ReplayCall]] = {}
+    for call in calls.values():
+        previous = call.data["previous"]
+        if previous is not None and previous in calls:
+            call.parent = calls[previous]
+            children.setdefault(previous, []).append(call)
+
+    def _place(call: ReplayCall) -> None:
+        # a node cannot be older than its parent, walk up iteratively for deep chains
+        path = []
+        while call.parent is not None and not call._placed:
+            path.append(call)
+            call = call.parent
+        at, depth, rooted = call.at, call.depth, call.rooted
+        for x in reversed(path):
+            at = x.at = max(x.at, at)
+            depth = x.depth = depth + 1
+            x.rooted = rooted
+            x._placed = True
+
+    for call in calls.values():
+        _place(call)
+    for siblings in children.values():
+        siblings.sort(key=lambda x: (x.at, x.data["id"]))
+        siblings[0].kind = "turn"
+        for x in siblings[1:]:
+            x.kind = "fork"
+    # nodes below a missing file cannot be replayed
+    ret = [x for x in calls.values() if x.rooted]
+    # parents sort before their children even with equal times
+    ret.sort(key=lambda x: (x.at, x.depth))
+    return ret
+
+
+def replay(url: str, calls: List[ReplayCall], compression: float, max_gap: float, concurrency: int,
+           model: str | None, timeout: float) -> tuple[List[tuple[str, int, float]], float, List[float]]:
+    # schedule with capped gaps, in seconds from the start of the replay
+    schedule = []
+    offset = 0.
+    for i, call in enumerate(calls):
+        if i:
+            offset += min(max_gap, (call.at - calls[i - 1].at) / compression)
+        schedule.append(offset)
+    results: List[tuple[str, int, float]] = []
+    lags: List[float] = []
+    lock = threading.Lock()
+    next_index = [0]
+    t0 = time.perf_counter()
+
+    def worker():
+        while True:
+            with lock:
+                i = next_index[0]
+                if i >= len(calls):
+                    return
+                next_index[0] += 1
+            call = calls[i]
+            try:
+                body: Dict[str, Any] = {"msg": call.data["user_message"]}
+                if call.parent is not None:
+                    # parents are picked before their children, so they are running or done
+                    call.parent.done.wait()
+                    if call.parent.new_session_id is None:
+                        with lock:
+                            results.append((call.kind, 0, 0.))
+                        continue
+                    body["sid"] = call.parent.new_session_id
+                else:
+                    body["system_msg"] = call.data["system_msg"]
+                    for field in ("user_name", "assistant_name"):
+                        if call.data.get(field) is not None:
+                            body[field] = call.data[field]
+                if model is not None:
+                    body["model"] = model
+                delay = schedule[i] - (time.perf_counter() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+                lag = max(0., -delay)
+                status, response, latency = post(f"{url}/api", body, timeout)
+                if status == 200:
+                    call.new_session_id = response["new_session_id"]
+                with lock:
+                    results.append((call.kind, status, latency))
+                    lags.append(lag)
+            finally:
+                call.done.set()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - t0, lags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_directory", help="OPENAI_DATA_FOLDER to replay, it is only read")
+    parser.add_argument("--compression", type=float, default=60., help="time compression factor")
+    parser.add_argument("--max-gap", type=float, default=5., help="maximum idle seconds between calls")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first calls")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--timeout", type=float, default=600.)
+    parser.add_argument("--url", default=None, help="use a running server instead of starting one")
+    parser.add_argument("--server-env", action="append", default=[], help="KEY=VALUE for the started server")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    fake_upstream.add_arguments(parser)
+    args = parser.parse_args()
+
+    calls = load_calls(args.data_directory)
+    if args.limit is not None:
+        # a prefix of the time order keeps every parent before its children
+        calls = calls[:args.limit]
+    print(f"{len(calls)} calls: " + ", ".join(f"{k} {sum(1 for x in calls if x.kind == k)}" for k in ("root", "turn", "fork")))
+    process = None
+    url = args.url
+    if url is None:
+        upstream = fake_upstream.serve(fake_upstream.config_from_args(args))
+        upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}/v1"
+        # never replay into the captured folder
+        data_directory = tempfile.mkdtemp(prefix="openai_session_replay_")
+        process, url = start_server(upstream_url, data_directory, dict(x.split("=", 1) for x in args.server_env))
+        print(f"Server on {url}, data in {data_directory}")
+    try:
+        results, elapsed, lags = replay(url, calls, args.compression, args.max_gap, args.concurrency,
+                                        args.model, args.timeout)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    report = summarize([r for r in results if r[1] != 0], elapsed)
+    report["skipped"] = sum(1 for r in results if r[1] == 0)
+    report["max_schedule_lag"] = round(max(lags), 4) if lags else 0.
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
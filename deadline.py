@@ -0,0 +1,121 @@
+import os
+import select
+import socket
+from threading import BoundedSemaphore
+from time import monotonic
+from typing import Any, Callable, Optional
+
+_DISCONNECT_POLL_INTERVAL = 0.25
+
+
+class RequestShed(Exception):
+    """
+    Raised when a request cannot start before its deadline expires.
+    """
+
+
+class RequestCancelled(Exception):
+    """
+    Raised when a running request is abandoned, either because its deadline
+    expired or because the client disconnected.
+    `partial` holds whatever was received from upstream before cancelling,
+    `new_session_id` is set if that partial result has been persisted.
+    """
+
+    def __init__(self, reason: str, partial: Any = None) -> None:
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+        self.partial = partial
+        self.new_session_id: int | None = None
+
+
+class Deadline:
+    """
+    Per-request deadline, optionally bound to a client disconnect check.
+    A `timeout` of None means the request never expires by time.
+    """
+
+    def __init__(self, timeout: float | None, is_disconnected: Optional[Callable[[], bool]] = None) -> None:
+        self.expires_at = None if timeout is None else monotonic() + timeout
+        self._is_disconnected = is_disconnected
+        self._disconnected = False
+        self._last_poll = 0.
+
+    def remaining(self) -> float | None:
+        if self.expires_at is None:
+            return None
+        return max(0., self.expires_at - monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and monotonic() >= self.expires_at
+
+    def disconnected(self) -> bool:
+        if self._disconnected or self._is_disconnected is None:
+            return self._disconnected
+        now = monotonic()
+        if now - self._last_poll < _DISCONNECT_POLL_INTERVAL:
+            return False
+        self._last_poll = now
+        self._disconnected = self._is_disconnected()
+        return self._disconnected
+
+    def cancel_reason(self) -> str | None:
+        """
+        Return why the request should be abandoned, or None if it may go on.
+        """
+        if self.expired():
+            return "deadline exceeded"
+        if self.disconnected():
+            return "client disconnected"
+        return None
+
+    def check(self, partial: Any = None) -> None:
+        reason = self.cancel_reason()
+        if reason is not None:
+            raise RequestCancelled(reason, partial)
+
+
+def socket_disconnect_checker(sock: socket.socket | None) -> Optional[Callable[[], bool]]:
+    """
+    Build a disconnect check for the client socket of a request.
+    The request body must have been consumed already: a readable socket
+    that yields no data means the peer has closed the connection.
+    """
+    if sock is None:
+        return None
+
+    def _check() -> bool:
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return False
+            return sock.recv(1, socket.MSG_PEEK) == b""
+        except (OSError, ValueError):
+            return True
+    return _check
+
+
+class AdmissionGate:
+    """
+    Bound the number of concurrent upstream calls.
+    Waiting requests are shed as soon as their deadline would expire.
+    """
+
+    def __init__(self, max_concurrent: int | None) -> None:
+        self._semaphore = BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def acquire(self, deadline: Deadline | None) -> None:
+        if self._semaphore is None:
+            return
+        timeout = None if deadline is None else deadline.remaining()
+        if not self._semaphore.acquire(timeout=timeout):
+            raise RequestShed("Request shed: no capacity to start before the deadline")
+
+    def release(self) -> None:
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+def env_float(name: str) -> float | None:
+    val = os.environ.get(name)
+    return float(val) if val else None
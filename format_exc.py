@@ -1,13 +1,23 @@
+import hashlib
+import os
 import re
+import reprlib
 import traceback
+from threading import Lock
+from time import monotonic, perf_counter
 from traceback import TracebackException
 from types import TracebackType
-from typing import Any
+from typing import Any, Dict
 
 _sentinel = getattr(traceback, "_sentinel")
 _parse_value_tb = getattr(traceback, "_parse_value_tb")
 _pattern = re.compile(r"^([\s]*)File")
 
+# budget for rendering local variables of one traceback
+_BUDGET_CHARS = int(os.environ.get("OPENAI_TRACEBACK_BUDGET_CHARS", "65536"))
+_BUDGET_SECONDS = float(os.environ.get("OPENAI_TRACEBACK_BUDGET_SECONDS", "0.05"))
+_MAX_VALUE_CHARS = 256
+
 
 def _matcher(text: str) -> int:
     match = re.match(_pattern, text)
@@ -17,19 +27,43 @@ def _matcher(text: str) -> int:
         return -1
 
 
+class _BoundedRepr(reprlib.Repr):
+    """
+    reprlib limits also for subclasses of the builtin containers, such as `SessionData`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.maxlevel = 3
+        self.maxdict = 8
+        self.maxlist = self.maxtuple = self.maxset = self.maxfrozenset = self.maxdeque = 8
+        self.maxstring = self.maxother = _MAX_VALUE_CHARS
+
+    def repr1(self, x, level):
+        if type(x).__repr__ is object.__repr__ or type(x) in (str, dict, list, tuple, set, frozenset):
+            return super().repr1(x, level)
+        for base in (dict, list, tuple):
+            if isinstance(x, base):
+                return f"{type(x).__name__}({getattr(self, 'repr_' + base.__name__)(x, level)})"
+        return super().repr1(x, level)
+
+
+_repr = _BoundedRepr()
+
+
 def _short_format(val):
-    rep = str(val)
-    if len(rep) > 256:
+    rep = _repr.repr(val)
+    if len(rep) > _MAX_VALUE_CHARS:
         suffix = "...<Too long to show>"
-        rep = rep[:256 - len(suffix)] + suffix
-    if isinstance(val, str):
-        rep = f'"{rep}"'
+        rep = rep[:_MAX_VALUE_CHARS - len(suffix)] + suffix
     return rep
 
 
 class _TracebackExceptionWithLocalVars(TracebackException):
     def format(self, *, tb: TracebackType | Any = _sentinel, chain=True, _ctx=None):
         frame = tb.tb_frame
+        end = perf_counter() + _BUDGET_SECONDS
+        chars = 0
         for val in super().format(chain=chain, _ctx=_ctx):
             yield val
             space_count = _matcher(val)
@@ -38,10 +72,15 @@ class _TracebackExceptionWithLocalVars(TracebackException):
                 prefix2 = ' ' * (space_count + 4)
                 cur_locals = frame.f_locals
                 if len(cur_locals) > 0:
-                    yield f"{prefix}Local variables:"
-                    for k, v in cur_locals.items():
-                        yield f"{prefix2}{k} = {_short_format(v)}"
-                    yield "\n"
+                    if chars > _BUDGET_CHARS or perf_counter() > end:
+                        yield f"{prefix}Local variables: <omitted, formatting budget exceeded>"
+                    else:
+                        yield f"{prefix}Local variables:"
+                        for k, v in cur_locals.items():
+                            line = f"{prefix2}{k} = {_short_format(v)}"
+                            chars += len(line)
+                            yield line
+                        yield "\n"
                 tb = tb.tb_next
                 frame = tb.tb_frame if tb is not None else None
 
@@ -50,3 +89,51 @@ def format_exception_with_local_vars(exc, /, value=_sentinel, tb=_sentinel, limi
     value, tb = _parse_value_tb(exc, value, tb)
     te = _TracebackExceptionWithLocalVars(type(value), value, tb, limit=limit, compact=True)
     return list(te.format(tb=tb, chain=chain))
+
+
+def exception_fingerprint(e: BaseException) -> str:
+    """
+    Identify an error by its type and the code locations of its traceback, not its message.
+    """
+    parts = [type(e).__qualname__]
+    tb = e.__traceback__
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        parts.append(f"{code.co_filename}:{tb.tb_lineno}:{code.co_name}")
+        tb = tb.tb_next
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+class ErrorThrottle(object):
+    """
+    Let the first occurrence of an error through, then at most one per `window`
+    seconds, reporting how many were suppressed in between.
+    """
+
+    def __init__(self, window: float = 60., max_entries: int = 1024) -> None:
+        self.window = window
+        self.max_entries = max_entries
+        self._lock = Lock()
+        # fingerprint -> (time of the last emission, suppressed since)
+        self._seen: Dict[str, list] = {}
+
+    def check(self, fingerprint: str) -> tuple[bool, int]:
+        """
+        Return whether to emit this occurrence, and the number suppressed before it.
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._seen.get(fingerprint)
+            if entry is None:
+                if len(self._seen) >= self.max_entries:
+                    # forget the oldest, dicts keep insertion order
+                    del self._seen[next(iter(self._seen))]
+                self._seen[fingerprint] = [now, 0]
+                return True, 0
+            if now - entry[0] < self.window:
+                entry[1] += 1
+                return False, entry[1]
+            suppressed = entry[1]
+            entry[0] = now
+            entry[1] = 0
+            return True, suppressed
@@ -0,0 +1,196 @@
+import os
+import re
+from time import monotonic
+from typing import Any, Dict, List, Mapping, Optional
+
+import openai
+
+from lock_stats import make_lock
+from openai_session_logging import WARNING, log
+
+# seconds a key stays out of rotation after an auth or quota error
+_HARD_QUARANTINE = 3600.
+# fallback when a rate limit error carries no reset hint
+_SOFT_QUARANTINE = 5.
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNIT = {"ms": 0.001, "s": 1., "m": 60., "h": 3600.}
+
+
+def _parse_duration(s: str | None) -> float | None:
+    """
+    Parse reset durations like "1s", "6m0s" or "20ms" from rate limit headers.
+    """
+    if not s:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(s)
+    if not parts:
+        return None
+    return sum(float(v) * _DURATION_UNIT[unit] for v, unit in parts)
+
+
+def _parse_int(s: str | None) -> int | None:
+    try:
+        return int(s) if s is not None else None
+    except ValueError:
+        return None
+
+
+class KeyState(object):
+    def __init__(self, key: str, client: openai.OpenAI) -> None:
+        self.key_id = f"{key[:3]}...{key[-4:]}" if len(key) > 10 else "..."
+        self.client = client
+        self.in_flight = 0
+        self.quarantined_until = 0.
+        self.quarantine_reason: str | None = None
+        # rate limit window as last reported by the provider
+        self.limit_requests: int | None = None
+        self.limit_tokens: int | None = None
+        self.remaining_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.reset_requests_at = 0.
+        self.reset_tokens_at = 0.
+        # usage counters
+        self.requests = 0
+        self.errors = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def headroom(self, now: float) -> float:
+        """
+        Fraction of the rate limit window still available, 1.0 when unknown.
+        """
+        ret = 1.
+        if self.remaining_requests is not None and self.limit_requests and now < self.reset_requests_at:
+            ret = min(ret, self.remaining_requests / self.limit_requests)
+        if self.remaining_tokens is not None and self.limit_tokens and now < self.reset_tokens_at:
+            ret = min(ret, self.remaining_tokens / self.limit_tokens)
+        return ret
+
+    def stats(self) -> Dict[str, Any]:
+        now = monotonic()
+        return {
+            "key": self.key_id,
+            "in_flight": self.in_flight,
+            "headroom": round(self.headroom(now), 4),
+            "quarantined_for": max(0., round(self.quarantined_until - now, 1)),
+            "quarantine_reason": self.quarantine_reason if self.quarantined_until > now else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+        }
+
+
+class ClientPool(object):
+    """
+    A pool of API keys for one provider.
+    Each request picks the key with the most rate limit headroom, keys that fail
+    with auth or quota errors are quarantined.
+    A pool without keys can be created, `acquire` then raises, so that a server
+    configured for one provider still starts.
+    `stream_usage` tells whether the provider accepts `stream_options.include_usage`.
+    """
+
+    def __init__(self, name: str, keys: List[str], base_url: str | None = None, stream_usage: bool = False) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.stream_usage = stream_usage
+        # the client raises at construction without a key
+        self._keys = [KeyState(k, openai.OpenAI(api_key=k, base_url=base_url)) for k in keys]
+        self._lock = make_lock("key_pool")
+
+    @classmethod
+    def from_env(cls, name: str, env_name: str, base_url: str | None = None, stream_usage: bool = False) -> "ClientPool":
+        """
+        Read keys from `<env_name>S` (comma separated), falling back to `<env_name>`.
+        """
+        raw = os.environ.get(f"{env_name}S") or os.environ.get(env_name) or ""
+        keys = [k.strip() for k in raw.split(",") if k.strip()]
+        return cls(name, keys, base_url, stream_usage)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def clients(self) -> List[openai.OpenAI]:
+        return [k.client for k in self._keys]
+
+    def acquire(self, exclude: Optional[List[KeyState]] = None) -> KeyState:
+        with self._lock:
+            now = monotonic()
+            if not self._keys:
+                raise openai.OpenAIError(f"No API key configured for {self.name}")
+            candidates = [k for k in self._keys if exclude is None or k not in exclude]
+            if not candidates:
+                raise RuntimeError(f"No API key left to try for {self.name}")
+            healthy = [k for k in candidates if k.quarantined_until <= now]
+            if healthy:
+                # prefer headroom, spread ties by in-flight requests
+                chosen = max(healthy, key=lambda k: (k.headroom(now), -k.in_flight))
+            else:
+                chosen = min(candidates, key=lambda k: k.quarantined_until)
+            chosen.in_flight += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, state: KeyState) -> None:
+        with self._lock:
+            state.in_flight -= 1
+
+    def update_from_headers(self, state: KeyState, headers: Mapping[str, str]) -> None:
+        now = monotonic()
+        with self._lock:
+            limit_requests = _parse_int(headers.get("x-ratelimit-limit-requests"))
+            limit_tokens = _parse_int(headers.get("x-ratelimit-limit-tokens"))
+            remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+            remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+            if limit_requests is not None:
+                state.limit_requests = limit_requests
+            if limit_tokens is not None:
+                state.limit_tokens = limit_tokens
+            if remaining_requests is not None:
+                state.remaining_requests = remaining_requests
+                state.reset_requests_at = now + (_parse_duration(headers.get("x-ratelimit-reset-requests")) or 60.)
+            if remaining_tokens is not None:
+                state.remaining_tokens = remaining_tokens
+                state.reset_tokens_at = now + (_parse_duration(headers.get("x-ratelimit-reset-tokens")) or 60.)
+
+    def record_usage(self, state: KeyState, tokens_in: int, tokens_out: int) -> None:
+        with self._lock:
+            state.tokens_in += tokens_in
+            state.tokens_out += tokens_out
+
+    def record_error(self, state: KeyState, e: Exception) -> bool:
+        """
+        Account an upstream error to the key.
+        Return True if the key was quarantined, so the request may be retried with another key.
+        """
+        now = monotonic()
+        with self._lock:
+            state.errors += 1
+            if isinstance(e, (openai.AuthenticationError, openai.PermissionDeniedError)):
+                state.quarantined_until = now + _HARD_QUARANTINE
+                state.quarantine_reason = type(e).__name__
+            elif isinstance(e, openai.RateLimitError):
+                if "insufficient_quota" in str(e):
+                    state.quarantined_until = now + _HARD_QUARANTINE
+                    state.quarantine_reason = "insufficient_quota"
+                else:
+                    headers = e.response.headers
+                    wait = _parse_duration(headers.get("retry-after")) \
+                        or _parse_duration(headers.get("x-ratelimit-reset-requests")) \
+                        or _SOFT_QUARANTINE
+                    state.quarantined_until = now + wait
+                    state.quarantine_reason = "rate_limited"
+            else:
+                return False
+        log(f"API key {state.key_id} of {self.name} quarantined: {state.quarantine_reason}", level=WARNING)
+        return True
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [k.stats() for k in self._keys]
@@ -0,0 +1,136 @@
+"""
+Optional lock contention instrumentation.
+With `OPENAI_LOCK_STATS` unset, `make_lock` returns a plain `threading.Lock`,
+so the instrumentation costs nothing.
+"""
+import heapq
+import os
+import sys
+import threading
+from time import perf_counter, time
+from typing import Any, Dict, List
+
+from metrics import FAST_BUCKETS, Histogram
+
+ENABLED = bool(os.environ.get("OPENAI_LOCK_STATS"))
+# number of longest holds kept for /admin/locks
+TOP_HOLDS = 20
+
+LOCK_WAIT_SECONDS = Histogram("openai_session_lock_wait_seconds", "Time spent waiting to acquire a lock.", ("site",), FAST_BUCKETS)
+LOCK_HOLD_SECONDS = Histogram("openai_session_lock_hold_seconds", "Time a lock was held.", ("site",), FAST_BUCKETS + (5., 30., 120.))
+
+
+class _SiteStats(object):
+    __slots__ = ("acquisitions", "contended", "timeouts", "wait_total", "wait_max", "hold_total", "hold_max")
+
+    def __init__(self) -> None:
+        self.acquisitions = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.hold_total = 0.
+        self.hold_max = 0.
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {k: round(v, 6) if isinstance(v, float) else v for k, v in ((k, getattr(self, k)) for k in self.__slots__)}
+
+
+_stats_lock = threading.Lock()
+_sites: Dict[str, _SiteStats] = {}
+# min-heap of (hold seconds, site, holder, thread name, unix time of release)
+_longest: List[tuple[float, str, str, str, float]] = []
+
+
+def _caller(depth: int) -> str:
+    f = sys._getframe(depth)
+    return f"{os.path.basename(f.f_code.co_filename)}:{f.f_lineno} {f.f_code.co_name}"
+
+
+class InstrumentedLock(object):
+    """
+    A `threading.Lock` recording acquisition wait and hold times under a site name.
+    """
+
+    def __init__(self, site: str) -> None:
+        self.site = site
+        self._lock = threading.Lock()
+        self._acquired_at = 0.
+        self._holder = ""
+
+    def acquire(self, blocking: bool = True, timeout: float = -1, _depth: int = 2) -> bool:
+        t0 = perf_counter()
+        contended = False
+        acquired = self._lock.acquire(False)
+        if not acquired and blocking:
+            contended = True
+            acquired = self._lock.acquire(True, timeout)
+        t1 = perf_counter()
+        wait = t1 - t0
+        if acquired:
+            self._acquired_at = t1
+            self._holder = _caller(_depth)
+        LOCK_WAIT_SECONDS.observe(wait, self.site)
+        with _stats_lock:
+            stats = _sites.get(self.site)
+            if stats is None:
+                stats = _sites[self.site] = _SiteStats()
+            stats.acquisitions += acquired
+            stats.contended += contended
+            stats.timeouts += not acquired and blocking
+            stats.wait_total += wait
+            stats.wait_max = max(stats.wait_max, wait)
+        return acquired
+
+    def release(self) -> None:
+        hold = perf_counter() - self._acquired_at
+        holder = self._holder
+        self._lock.release()
+        LOCK_HOLD_SECONDS.observe(hold, self.site)
+        with _stats_lock:
+            stats = _sites[self.site]
+            stats.hold_total += hold
+            stats.hold_max = max(stats.hold_max, hold)
+            entry = (hold, self.site, holder, threading.current_thread().name, time())
+            if len(_longest) < TOP_HOLDS:
+                heapq.heappush(_longest, entry)
+            elif hold > _longest[0][0]:
+                heapq.heapreplace(_longest, entry)
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire(_depth=3)
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+def make_lock(site: str):
+    """
+    Return a lock for `site`, instrumented only if `OPENAI_LOCK_STATS` is set.
+    """
+    if ENABLED:
+        return InstrumentedLock(site)
+    return threading.Lock()
+
+
+def snapshot() -> Dict[str, Any]:
+    with _stats_lock:
+        sites = {k: v.as_dict() for k, v in _sites.items()}
+        longest = sorted(_longest, reverse=True)
+    return {
+        "enabled": ENABLED,
+        "sites": sites,
+        "longest_holds": [
+            {"hold": round(hold, 6), "site": site, "holder": holder, "thread": thread, "released_at": released_at}
+            for hold, site, holder, thread, released_at in longest
+        ],
+    }
+
+
+def reset() -> None:
+    with _stats_lock:
+        _sites.clear()
+        _longest.clear()
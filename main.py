@@ -1,15 +1,23 @@
 #!/usr/bin/env -S python3 -O
 
+import hashlib
+import hmac
 import os
 import sys
+from time import perf_counter, process_time
 from typing import TYPE_CHECKING
 
 import openai
 
-from format_exc import format_exception_with_local_vars
-from model_wrap import STR_MODEL_DICT, model_string_to_model
-from openai_session import SessionKeeper
-from openai_session_logging import log
+import metrics
+import profiling
+import tracing
+from deadline import AdmissionGate, Deadline, RequestCancelled, RequestShed, env_float, socket_disconnect_checker
+from format_exc import ErrorThrottle, exception_fingerprint, format_exception_with_local_vars
+from model_wrap import STR_MODEL_DICT, TIKTOKEN_NAME_DICT, model_provider, model_string_to_model
+from openai_session import SessionKeeper, count_tokens_batch
+from openai_session_logging import ERROR, WARNING, log
+from warmup import Warmup
 
 if TYPE_CHECKING:
     from flask.typing import ResponseReturnValue
@@ -51,6 +59,8 @@ if __name__ == "__main__":
         exit(1)
     if not os.path.exists(data_directory):
         os.makedirs(data_directory)
+    # keep downloaded encodings across restarts instead of in the system temp folder
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(data_directory, "tiktoken_cache"))
 
     port_str = os.environ.get("OPENAI_PORT")
     if port_str is None:
@@ -62,26 +72,89 @@ if __name__ == "__main__":
     if _use_model_name is not None:
         set_default_model(_use_model_name)
 
-    sessions = SessionKeeper(data_directory)
+    # seconds, used when a request does not carry its own timeout
+    default_timeout = env_float("OPENAI_REQUEST_TIMEOUT")
+    _max_calls = os.environ.get("OPENAI_MAX_CONCURRENT_CALLS")
+    admission = AdmissionGate(int(_max_calls) if _max_calls else None)
+
+    persist_partial = bool(os.environ.get("OPENAI_PERSIST_PARTIAL"))
+    startup = {"imports_cpu": round(process_time(), 4)}
+    _t0 = perf_counter()
+    replica = None
+    if os.environ.get("OPENAI_REPLICA"):
+        import socket
+
+        from session_cdc import SessionReplica
+        replica = SessionReplica(data_directory, os.environ.get("OPENAI_REPLICA_NAME") or socket.gethostname())
+        sessions = replica.start(persist_partial=persist_partial)
+    else:
+        sessions = SessionKeeper(data_directory, persist_partial=persist_partial)
+        if os.environ.get("OPENAI_CDC"):
+            from session_cdc import ChangeEmitter
+            sessions.change_listener = ChangeEmitter()
+    startup["load_sessions"] = round(perf_counter() - _t0, 4)
+    warm = Warmup(startup).start()
+    metrics.SESSIONS_IN_MEMORY.set_function(lambda: len(sessions))
     app = flask.Flask(__name__)
 
+    error_throttle = ErrorThrottle(float(os.environ.get("OPENAI_ERROR_LOG_WINDOW", "60")))
+
     def _on_exception(e: Exception):
+        # identical errors are formatted and logged at most once per window
+        emit, suppressed = error_throttle.check(exception_fingerprint(e))
+        if not emit:
+            return repr(e)
+        repeated = f"[repeated {suppressed} more times since last logged] " if suppressed else ""
         try:
             if app.debug:
                 ret = format_exception_with_local_vars(type(e), e, e.__traceback__)
                 ret_str = "\n".join(ret)
-                log(ret_str)
+                log(repeated + ret_str, level=ERROR)
                 return ret_str
         except Exception:
             ...
         ret_str = repr(e)
-        log(ret_str)
+        log(repeated + ret_str, level=ERROR)
         return ret_str
 
+    admin_token = os.environ.get("OPENAI_ADMIN_TOKEN")
+
+    def _admin_denied() -> bool:
+        return admin_token is not None and flask.request.headers.get("X-Admin-Token") != admin_token
+
+    @app.before_request
+    def _start_timer() -> None:
+        flask.g.request_start = perf_counter()
+        if flask.request.endpoint == "api":
+            flask.g.trace = tracing.start("api")
+
+    @app.after_request
+    def _observe_request(response: "flask.Response") -> "flask.Response":
+        model = flask.g.get("model")
+        if flask.request.endpoint == "api" and model is not None:
+            metrics.REQUEST_SECONDS.observe(
+                perf_counter() - flask.g.request_start, str(model), model_provider(model.id), str(response.status_code))
+        trace = flask.g.get("trace")
+        if trace is not None:
+            tracing.finish(trace)
+            response.headers["Server-Timing"] = trace.server_timing()
+        return response
+
+    @app.teardown_request
+    def _finish_trace(_) -> None:
+        # after_request is skipped when the view raised
+        trace = flask.g.get("trace")
+        if trace is not None:
+            tracing.finish(trace)
+
     @app.route("/api", methods=["POST"])
     def api() -> "ResponseReturnValue":
         data: dict = flask.request.json  # type: ignore
         try:
+            if not warm.ready.is_set():
+                return "Warming up", 503
+            if replica is not None:
+                return "Read-only replica, promote it first", 503
             if not data:
                 return "No data provided", 400
             if "msg" not in data:
@@ -101,36 +174,259 @@ if __name__ == "__main__":
             if sid is not None and assistant_name is not None:
                 return "Cannot specify assistant_name for an existing session", 400
             model = model_string_to_model(str(data.get("model", DEFAULT_MODEL)))
+            flask.g.model = model
 
             def string_check(x):
                 return not (x is not None and not isinstance(x, str))
             #
             if not all(map(string_check, [msg, system_msg, user_name, assistant_name])):
                 return "msg, system_msg, user_name, assistant_name must be strings", 400
+            timeout_raw = data.get("timeout", flask.request.headers.get("X-Request-Timeout"))
+            timeout = float(timeout_raw) if timeout_raw is not None else default_timeout
+            if timeout is not None and timeout <= 0:
+                return "timeout must be positive", 400
             # all check completed
-            response = sessions.call(sid, msg, model, system_msg, user_name, assistant_name)
-            ret = {
-                "text": response.msg.content,
-                "token_in": response.token_in,
-                "token_out": response.token_out,
-                "new_session_id": response.new_session_id,
-            }
-            reasoning_content = getattr(response.msg, "reasoning_content", None)
-            if reasoning_content:
-                ret["reasoning_content"] = reasoning_content
+            deadline = Deadline(timeout, socket_disconnect_checker(flask.request.environ.get("werkzeug.socket")))
+            _t0 = perf_counter()
+            with tracing.span("admission"):
+                admission.acquire(deadline)
+            metrics.QUEUE_WAIT_SECONDS.observe(perf_counter() - _t0, "admission")
+            try:
+                with profiling.maybe_profile():
+                    response = sessions.call(sid, msg, model, system_msg, user_name, assistant_name, deadline)
+            finally:
+                admission.release()
+            ret = response.as_dict()
+            if data.get("timings"):
+                ret["timings"] = flask.g.trace.timings()
             return ret
-        except openai.RateLimitError:
-            log("Token rate limit exceeded!")
+        except openai.RateLimitError as e:
+            metrics.ERRORS_TOTAL.inc(metrics.error_label(e))
+            log("Token rate limit exceeded!", level=WARNING)
             return "Token rate limit exceeded", 503
+        except RequestShed as e:
+            metrics.ERRORS_TOTAL.inc(metrics.error_label(e))
+            log(str(e), level=WARNING)
+            return str(e), 503
+        except RequestCancelled as e:
+            metrics.ERRORS_TOTAL.inc(metrics.error_label(e))
+            log(f"{e}, partial result saved as: {e.new_session_id}", level=WARNING)
+            if e.new_session_id is None:
+                return str(e), 504
+            return {
+                "error": str(e),
+                "text": e.partial.content,
+                "new_session_id": e.new_session_id,
+            }, 504
         except Exception as e:
+            metrics.ERRORS_TOTAL.inc(metrics.error_label(e))
             err = _on_exception(e)
             print(err)
             return err, 400
 
+    @app.route("/count_tokens", methods=["POST"])
+    def count_tokens() -> "ResponseReturnValue":
+        data: dict = flask.request.get_json(silent=True)  # type: ignore
+        if not data:
+            return "No data provided", 400
+        model_names = data.get("models") or [data.get("model", DEFAULT_MODEL)]
+        if not isinstance(model_names, list):
+            return "models must be a list", 400
+        try:
+            models = {str(x): model_string_to_model(str(x)) for x in model_names}
+        except ValueError as e:
+            return str(e), 400
+        if "texts" in data:
+            texts = data["texts"]
+            if not isinstance(texts, list) or not all(isinstance(x, str) for x in texts):
+                return "texts must be a list of strings", 400
+            # models sharing an encoding are counted once
+            by_encoding = {}
+            counts = {}
+            for name, model in models.items():
+                encoding = TIKTOKEN_NAME_DICT[model.id]
+                if encoding not in by_encoding:
+                    by_encoding[encoding] = count_tokens_batch(texts, model)
+                counts[name] = by_encoding[encoding]
+            return {"counts": counts}
+        try:
+            sid = int(data["sid"])
+            msg = data["msg"]
+            if not isinstance(msg, str):
+                raise TypeError("msg must be a string")
+        except (KeyError, TypeError, ValueError):
+            return "Provide texts, or an integer sid and a string msg", 400
+        session = sessions.get(sid)
+        if session is None:
+            return "Invalid sid", 400
+        try:
+            return {"projections": {name: session.project(msg, model) for name, model in models.items()}}
+        except Exception as e:
+            return _on_exception(e), 400
+
+    _HISTORY_FIELDS = ("user_message", "assistant_message", "user_name", "assistant_name")
+    _HISTORY_OPTIONAL = ("reasoning_content", "system_msg")
+    # signs history cursors, random per process unless set
+    _cursor_secret = (os.environ.get("OPENAI_CURSOR_SECRET") or os.urandom(16).hex()).encode()
+
+    def _cursor_mac(sid: int, node_id: int) -> str:
+        return hmac.new(_cursor_secret, f"{sid}:{node_id}".encode(), hashlib.sha256).hexdigest()[:16]
+
+    @app.route("/history", methods=["GET"])
+    def history() -> "ResponseReturnValue":
+        args = flask.request.args
+        try:
+            sid = int(args["sid"])
+            limit = min(500, max(1, int(args.get("limit", 50))))
+        except (KeyError, ValueError):
+            return "sid is required, sid and limit must be integers", 400
+        cursor = sid
+        if args.get("cursor"):
+            # the cursor names a node on the chain of sid, signed so that it is checked without walking the chain
+            node_id, _, mac = args["cursor"].partition(".")
+            if not node_id.isdigit() or not hmac.compare_digest(mac, _cursor_mac(sid, int(node_id))):
+                return "cursor is not a next_cursor of this sid", 400
+            cursor = int(node_id)
+        include = tuple(x for x in _HISTORY_OPTIONAL if x in args.get("include", "").split(","))
+        node = sessions.get(cursor)
+        if node is None:
+            return "Invalid sid", 404
+        # walk up from the cursor instead of building the whole chain
+        nodes = []
+        while node is not None and len(nodes) < limit:
+            data = node.data
+            item = {"sid": data.id}
+            for field in _HISTORY_FIELDS + include:
+                item[field] = data.get(field)
+            nodes.append(item)
+            node = sessions.get(data.previous) if data.previous is not None else None
+        next_cursor = f"{node.data.id}.{_cursor_mac(sid, node.data.id)}" if node is not None else None
+        response = flask.jsonify({"sid": sid, "nodes": nodes, "next_cursor": next_cursor})
+        # nodes can still change (a pending answer, a replicated update), so the ETag hashes the page itself
+        response.add_etag()
+        return response.make_conditional(flask.request)
+
+    @app.route("/ready", methods=["GET"])
+    def ready() -> "ResponseReturnValue":
+        return warm.status(), 200 if warm.ready.is_set() else 503
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint() -> "ResponseReturnValue":
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
     @app.route("/list_models", methods=["GET"])
     def list_models() -> "ResponseReturnValue":
         return flask.jsonify(list(STR_MODEL_DICT.keys()))
 
+    @app.route("/admin/keys", methods=["GET"])
+    def admin_keys() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        from api_call import DEEPSEEK_CLIENT, OPENAI_CLIENT
+        return {pool.name: pool.stats() for pool in (OPENAI_CLIENT, DEEPSEEK_CLIENT)}
+
+    @app.route("/admin/locks", methods=["GET", "DELETE"])
+    def admin_locks() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        import lock_stats
+        if flask.request.method == "DELETE":
+            lock_stats.reset()
+            return "Reset"
+        return lock_stats.snapshot()
+
+    @app.route("/admin/memory", methods=["GET", "DELETE"])
+    def admin_memory() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        import memory_report
+        if flask.request.method == "DELETE":
+            memory_report.stop_tracemalloc()
+            return "Stopped"
+        top = flask.request.args.get("tracemalloc")
+        try:
+            trees = int(flask.request.args.get("trees", 10))
+            top_n = int(top or 10) if top is not None else None
+        except ValueError:
+            return "trees and tracemalloc must be integers", 400
+        if trees < 0 or (top_n is not None and top_n <= 0):
+            return "trees must not be negative and tracemalloc must be positive", 400
+        ret = {
+            "process": memory_report.process_report(),
+            "sessions": memory_report.session_report(sessions, trees),
+            "tokenizers": memory_report.tokenizer_report(),
+        }
+        if top_n is not None:
+            ret["tracemalloc"] = memory_report.tracemalloc_top(top_n)
+        return ret
+
+    @app.route("/admin/profile", methods=["GET", "POST"])
+    def admin_profile() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        if flask.request.method == "GET":
+            return profiling.status(data_directory)
+        body: dict = flask.request.get_json(silent=True) or {}
+        try:
+            return profiling.start(
+                data_directory,
+                str(body.get("mode", "sample")),
+                float(body.get("seconds", 30)),
+                float(body.get("interval", 0.01)),
+                float(body.get("fraction", 1.)),
+            )
+        except ValueError as e:
+            return str(e), 400
+        except RuntimeError as e:
+            return str(e), 409
+
+    @app.route("/admin/export", methods=["GET"])
+    def admin_export() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        import session_export
+        try:
+            roots = [int(x) for x in flask.request.args.getlist("root")] or None
+            since = float(flask.request.args["since"]) if "since" in flask.request.args else None
+        except ValueError:
+            return "root must be an integer and since a unix time", 400
+        return flask.Response(
+            session_export.iter_export(session_export.iter_nodes(sessions, roots, since)),
+            mimetype="application/gzip",
+            headers={"Content-Disposition": "attachment; filename=sessions.ndjson.gz"},
+        )
+
+    @app.route("/admin/import", methods=["POST"])
+    def admin_import() -> "ResponseReturnValue":
+        if _admin_denied():
+            return "Forbidden", 403
+        if replica is not None:
+            return "Read-only replica, promote it first", 503
+        import session_export
+        try:
+            batch_size = int(flask.request.args.get("batch_size", 1000))
+        except ValueError:
+            batch_size = 0
+        if batch_size <= 0:
+            return "batch_size must be a positive integer", 400
+        try:
+            return session_export.import_stream(sessions, flask.request.stream, batch_size)
+        except (OSError, EOFError) as e:
+            return f"Invalid gzip stream: {e}", 400
+
+    @app.route("/admin/promote", methods=["POST"])
+    def admin_promote() -> "ResponseReturnValue":
+        global replica
+        if _admin_denied():
+            return "Forbidden", 403
+        if replica is None:
+            return "Not a replica", 400
+        if replica.missed and flask.request.args.get("force") != "1":
+            return f"Replica missed {replica.missed} change events, reload it from the data folder or pass force=1", 409
+        replica.promote()
+        replica = None
+        return "Promoted"
+
 
 if __name__ == "__main__":
     debug = bool(os.environ.get("OPENAI_SESSION_DEBUG_MODE"))
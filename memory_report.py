@@ -0,0 +1,131 @@
+"""
+Memory introspection for `/admin/memory`.
+The session report is a single pass over the nodes without locks, cheap enough to poll.
+"""
+import os
+import resource
+import sys
+import tracemalloc
+from typing import TYPE_CHECKING, Any, Dict, List
+
+import tiktoken.registry
+
+if TYPE_CHECKING:
+    from openai_session import SessionKeeper
+
+_FIELDS = ("system_msg", "user_message", "assistant_message", "reasoning_content", "summary")
+# estimated sizes of loaded encodings, computed once per encoding
+_encoding_bytes: Dict[str, int] = {}
+
+
+def _str_bytes(s: str | None) -> int:
+    return sys.getsizeof(s) if s is not None else 0
+
+
+def _depth_bucket(depth: int) -> str:
+    bound = 1
+    while bound < depth:
+        bound *= 2
+    return f"<={bound}"
+
+
+def session_report(keeper: "SessionKeeper", top_trees: int = 10) -> Dict[str, Any]:
+    nodes = keeper.values()
+    by_field = dict.fromkeys(_FIELDS, 0)
+    overhead = 0
+    if nodes:
+        # every node has the same layout, measure one
+        t = nodes[0]
+        overhead = len(nodes) * (sys.getsizeof(t) + sys.getsizeof(t.__dict__) + sys.getsizeof(t.data) + sys.getsizeof(t._lock))
+    by_id = {t.data.id: t for t in nodes}
+    # sid -> (depth, root sid)
+    placed: Dict[int, tuple[int, int]] = {}
+    trees: Dict[int, List[int]] = {}
+    depths: Dict[str, int] = {}
+    for t in nodes:
+        data = t.data
+        node_bytes = 0
+        for field in _FIELDS:
+            n = _str_bytes(data.get(field))
+            by_field[field] += n
+            node_bytes += n
+        # walk up to the first placed ancestor, then place the walked path
+        path = []
+        sid = data.id
+        while sid not in placed:
+            path.append(sid)
+            previous = by_id[sid].data.previous
+            if previous is None or previous not in by_id:
+                placed[path.pop()] = (1, sid)
+                break
+            sid = previous
+        depth, root = placed[sid]
+        for x in reversed(path):
+            depth += 1
+            placed[x] = (depth, root)
+        depth, root = placed[data.id]
+        bucket = _depth_bucket(depth)
+        depths[bucket] = depths.get(bucket, 0) + 1
+        tree = trees.get(root)
+        if tree is None:
+            tree = trees[root] = [0, 0, 0]
+        tree[0] += 1
+        tree[1] += node_bytes
+        tree[2] = max(tree[2], depth)
+    largest = sorted(trees.items(), key=lambda x: x[1][1], reverse=True)[:top_trees]
+    return {
+        "nodes": len(nodes),
+        "trees": len(trees),
+        "bytes_by_field": by_field,
+        "node_overhead_bytes": overhead,
+        "depth_distribution": dict(sorted(depths.items(), key=lambda x: int(x[0][2:]))),
+        "largest_trees": [
+            {"root": str(root), "nodes": n, "bytes": b, "max_depth": d} for root, (n, b, d) in largest
+        ],
+    }
+
+
+def tokenizer_report() -> Dict[str, Any]:
+    ret = {}
+    for name, enc in list(tiktoken.registry.ENCODINGS.items()):
+        size = _encoding_bytes.get(name)
+        if size is None:
+            ranks = enc._mergeable_ranks
+            size = sys.getsizeof(ranks) + sum(sys.getsizeof(k) for k in ranks) + sys.getsizeof(0) * len(ranks)
+            _encoding_bytes[name] = size
+        ret[name] = {"n_vocab": enc.n_vocab, "estimated_bytes": size}
+    return ret
+
+
+def process_report() -> Dict[str, Any]:
+    ret: Dict[str, Any] = {"max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            ret["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    return ret
+
+
+def tracemalloc_top(n: int) -> Dict[str, Any]:
+    """
+    Top `n` allocation sites since tracing started.
+    The first call only starts tracing, as earlier allocations are not tracked.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return {"started": True}
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced_bytes": current,
+        "traced_peak_bytes": peak,
+        "top": [
+            {"location": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:n]
+        ],
+    }
+
+
+def stop_tracemalloc() -> None:
+    tracemalloc.stop()
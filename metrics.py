@@ -0,0 +1,148 @@
+"""
+Minimal Prometheus metrics, rendered in the text exposition format by `/metrics`.
+Label values must come from bounded sets (model names, providers, error classes).
+"""
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+_REGISTRY: List["_Metric"] = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric(object):
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        _REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, f: Callable[[], float]) -> None:
+        """
+        Compute the (unlabelled) value at scrape time.
+        """
+        self._function = f
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {self._function()}"]
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> (per bucket counts, with +Inf last, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(counts), total[0]) for k, (counts, total) in self._values.items()]
+        ret = []
+        for k, counts, total in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self.labelnames, k, 'le="' + le + '"')
+                ret.append(f"{self.name}_bucket{labels} {cumulative}")
+            ret.append(f"{self.name}_sum{_format_labels(self.labelnames, k)} {total}")
+            ret.append(f"{self.name}_count{_format_labels(self.labelnames, k)} {cumulative}")
+        return ret
+
+
+def render() -> str:
+    return "\n".join(line for m in _REGISTRY for line in m.render()) + "\n"
+
+
+# bounded set of error classes, everything else is reported as "other"
+_KNOWN_ERRORS = {
+    "RateLimitError", "BadRequestError", "AuthenticationError", "PermissionDeniedError", "NotFoundError",
+    "APITimeoutError", "APIConnectionError", "InternalServerError", "APIStatusError",
+    "RequestShed", "RequestCancelled", "ValueError", "RuntimeError", "KeyError", "TypeError",
+}
+
+
+def error_label(e: BaseException) -> str:
+    name = type(e).__name__
+    return name if name in _KNOWN_ERRORS else "other"
+
+
+REQUEST_SECONDS = Histogram("openai_session_request_seconds", "Latency of /api requests.", ("model", "provider", "status"))
+UPSTREAM_TTFT_SECONDS = Histogram("openai_session_upstream_ttft_seconds", "Time to the first upstream token.", ("model", "provider"))
+UPSTREAM_TOKENS_PER_SECOND = Histogram(
+    "openai_session_upstream_tokens_per_second", "Upstream generation speed after the first token.", ("model", "provider"), RATE_BUCKETS)
+TOKENIZE_SECONDS = Histogram("openai_session_tokenize_seconds", "Time spent counting tokens to cut the history.", ("model",), FAST_BUCKETS)
+CHAIN_LENGTH = Histogram("openai_session_chain_length", "Number of nodes in the chain of a call.", (), COUNT_BUCKETS)
+PERSIST_SECONDS = Histogram("openai_session_persist_seconds", "Time spent writing a session file.", (), FAST_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram("openai_session_queue_wait_seconds", "Time spent waiting before a call could start.", ("queue",))
+TOKENS_TOTAL = Counter("openai_session_tokens_total", "Tokens sent and received.", ("model", "provider", "direction"))
+COST_DOLLARS_TOTAL = Counter("openai_session_cost_dollars_total", "Estimated cost from PRICING_DICT.", ("model", "provider", "direction"))
+ERRORS_TOTAL = Counter("openai_session_errors_total", "Failed /api requests by error class.", ("error",))
+CONTEXT_OVERFLOW_RETRIES_TOTAL = Counter(
+    "openai_session_context_overflow_retries_total", "Calls retried with less history after a context length error.", ("model",))
+SESSIONS_IN_MEMORY = Gauge("openai_session_sessions_in_memory", "Number of session nodes in memory.")
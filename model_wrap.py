@@ -109,5 +109,9 @@ def model_string_to_model(s: str) -> ModelWrapper:
     return ModelWrapper(model_int)
 
 
+def model_provider(model_id: int) -> str:
+    return "deepseek" if model_id == DEEPSEEK_R1 else "openai"
+
+
 def repr_supported_models():
     return "Supported models: " + ", ".join([str(m) for m in MODEL_DICT.values()])
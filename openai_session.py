@@ -1,15 +1,27 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from os import urandom
 from struct import unpack
-from threading import Lock
-from typing import Callable, Dict, List, Optional, Union
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import openai
 import tiktoken
 
 from api_call import ObjectDict, completion_api_call
+from deadline import Deadline, RequestCancelled, RequestShed
+from lock_stats import make_lock
+from metrics import (
+    CHAIN_LENGTH,
+    CONTEXT_OVERFLOW_RETRIES_TOTAL,
+    COST_DOLLARS_TOTAL,
+    PERSIST_SECONDS,
+    QUEUE_WAIT_SECONDS,
+    TOKENIZE_SECONDS,
+    TOKENS_TOTAL,
+)
 from model_wrap import (
     GPT3_5,
     MODEL_DICT,
@@ -17,15 +29,61 @@ from model_wrap import (
     TIKTOKEN_NAME_DICT,
     TOKEN_LIMIT_DICT,
     ModelWrapper,
+    model_provider,
+    model_string_to_model,
 )
-from openai_session_logging import log
+from openai_session_logging import DEBUG, WARNING, log
 from openai_typing import OpenAIMessageWrapper
+from partitioning import jump_hash
+from tracing import span
 
 ModelType = Union[int, ModelWrapper]
 
 _INPUT = 0
 _OUTPUT = 1
 
+# "sliding" recomputes the cut every turn, "chunked" keeps it stable for prompt caching
+TRUNCATION_POLICY = os.environ.get("OPENAI_TRUNCATION_POLICY", "sliding")
+# cut points of the chunked policy are aligned to this many messages
+TRUNCATION_CHUNK = int(os.environ.get("OPENAI_TRUNCATION_CHUNK", "16"))
+# fraction of the token limit left in use after the chunked policy drops history
+TRUNCATION_LOW_WATER = float(os.environ.get("OPENAI_TRUNCATION_LOW_WATER", "0.5"))
+# send a prompt cache key derived from the root sid
+PROMPT_CACHE_KEY = bool(os.environ.get("OPENAI_PROMPT_CACHE_KEY"))
+
+# fraction of the token limit at which old history is summarized, compaction is off if unset
+_compaction_threshold = os.environ.get("OPENAI_COMPACTION_THRESHOLD")
+COMPACTION_THRESHOLD = float(_compaction_threshold) if _compaction_threshold else None
+# fraction of the token limit kept verbatim after compaction
+COMPACTION_KEEP = float(os.environ.get("OPENAI_COMPACTION_KEEP", "0.25"))
+COMPACTION_MODEL = os.environ.get("OPENAI_COMPACTION_MODEL", "GPT4O_MINI")
+_COMPACTION_PROMPT = (
+    "Summarize the conversation below so that it can replace it as context for continuing the conversation. "
+    "Keep facts, decisions, names, numbers and open questions. Reply with the summary only."
+)
+_compaction_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+_compaction_pending: set[int] = set()
+_compaction_lock = make_lock("compaction")
+# model id -> encoding, encoding_for_model resolves the name on every call
+_encodings: Dict[int, tiktoken.Encoding] = {}
+# threads used by tiktoken to encode a batch
+TOKENIZER_THREADS = int(os.environ.get("OPENAI_TOKENIZER_THREADS", "4"))
+
+
+def encoding_for(model: ModelWrapper) -> tiktoken.Encoding:
+    enc = _encodings.get(model.id)
+    if enc is None:
+        enc = _encodings[model.id] = tiktoken.encoding_for_model(TIKTOKEN_NAME_DICT[model.id])
+    return enc
+
+
+def count_tokens_batch(texts: List[str], model: ModelWrapper) -> List[int]:
+    """
+    Token count of each text, encoded by tiktoken across its thread pool.
+    Special tokens are counted as plain text, like `OpenAISession._count_token_for`.
+    """
+    return [len(x) for x in encoding_for(model).encode_batch(texts, num_threads=TOKENIZER_THREADS, disallowed_special=())]
+
 
 class CallReturnData(object):
     msg: OpenAIMessageWrapper
@@ -33,6 +91,21 @@ class CallReturnData(object):
     token_out: int
     new_session_id: int
     reasoning_content: str | None
+    cached_tokens: int | None
+
+    def as_dict(self) -> Dict[str, Any]:
+        ret: Dict[str, Any] = {
+            "text": self.msg.content,
+            "token_in": self.token_in,
+            "token_out": self.token_out,
+            "new_session_id": self.new_session_id,
+        }
+        reasoning_content = getattr(self.msg, "reasoning_content", None)
+        if reasoning_content:
+            ret["reasoning_content"] = reasoning_content
+        if self.cached_tokens is not None:
+            ret["cached_tokens"] = self.cached_tokens
+        return ret
 
 
 @dataclass
@@ -45,6 +118,12 @@ class SessionData(ObjectDict):
     user_name: str | None
     assistant_name: str | None
     reasoning_content: str | None
+    # fields below have no default either: a class attribute would shadow the dict lookup of ObjectDict
+    # index of the first history message sent upstream when this node was answered
+    history_cut: int | None
+    # summary of history[:summary_upto] of the chain ending at this node
+    summary: str | None
+    summary_upto: int | None
 
     def gen_seq(self):
         return self.gen_seq_static(self.user_message, self.assistant_message, self.user_name, self.assistant_name)
@@ -74,9 +153,13 @@ class SessionData(ObjectDict):
 
     @classmethod
     def deserialize(cls, fp):
-        o = json.load(fp)
-        if "reasoning_content" not in o:
-            o["reasoning_content"] = None
+        return cls.from_dict(json.load(fp))
+
+    @classmethod
+    def from_dict(cls, o: Dict[str, Any]):
+        for field in ("reasoning_content", "history_cut", "summary", "summary_upto"):
+            if field not in o:
+                o[field] = None
         return cls(**o)
 
 
@@ -96,17 +179,23 @@ class OpenAISession:
     ) -> None:
         if (previous is None) == (system_msg is None):
             raise RuntimeError("Logic error: previous and system_msg should be exclusive, and at least one should be provided")
-        self.data = SessionData(sid, system_msg, previous, user_message, assistant_message, user_name, assistant_name, reasoning_content)
-        self._lock = Lock()
+        self.data = SessionData(sid, system_msg, previous, user_message, assistant_message, user_name, assistant_name, reasoning_content, None, None, None)
+        self._lock = make_lock("session")
 
     def save(self, folder: str) -> None:
         with self._lock:
             self._save(folder)
 
     def _save(self, folder: str) -> None:
-        filename = os.path.join(folder, f"s_{self.data.id}.json")
-        with open(filename, "w", encoding='utf-8') as f:
-            f.write(self.data.serialize())
+        with span("save"):
+            _t0 = perf_counter()
+            filename = os.path.join(folder, f"s_{self.data.id}.json")
+            with open(filename, "w", encoding='utf-8') as f:
+                f.write(self.data.serialize())
+            PERSIST_SECONDS.observe(perf_counter() - _t0)
+            listener = self.sessions_keeper.change_listener  # pylint: disable=no-member
+            if listener is not None:
+                listener(self.data)
 
     # def parseHistory(self):
     #     for i, x in enumerate(self.history):
@@ -118,14 +207,32 @@ class OpenAISession:
     #                 "content": x.content
     #             }
 
-    def call_self(self, model: ModelType):
-        with self._lock:
+    def _acquire(self, deadline: Deadline | None) -> None:
+        timeout = None if deadline is None else deadline.remaining()
+        _t0 = perf_counter()
+        with span("session_lock"):
+            acquired = self._lock.acquire(timeout=-1 if timeout is None else timeout)
+        QUEUE_WAIT_SECONDS.observe(perf_counter() - _t0, "session_lock")
+        if not acquired:
+            raise RequestShed(f"Request shed: session {self.data.id} is busy past the deadline")
+
+    def call_self(self, model: ModelType, deadline: Deadline | None = None):
+        self._acquire(deadline)
+        try:
             assert self.data.system_msg is not None
             model = model if isinstance(model, ModelWrapper) else ModelWrapper(model)
-            response, token_in = self._internal_call(self.data.system_msg, self.data.gen_seq(), model)
+            try:
+                response, token_in, _ = self._internal_call(self.data.system_msg, self.data.gen_seq(), model, deadline)
+            except RequestCancelled as e:
+                if self.sessions_keeper.persist_partial and e.partial is not None and e.partial.content:  # pylint: disable=no-member
+                    self.data.assistant_message = e.partial.content
+                    self.data.reasoning_content = e.partial.reasoning_content
+                    self._save(self.sessions_keeper.data_directory)  # pylint: disable=no-member
+                    e.new_session_id = self.data.id
+                raise
             self._token_usage_hint(token_in, model, _INPUT)
             out_msg = response
-            log(f"sid: {self.data.id} got response: {out_msg}")
+            log(f"sid: {self.data.id} got response: {out_msg}", level=DEBUG)
             token_out = self._out_token_usage_check(model, out_msg.content)
             self.data.assistant_message = out_msg.content
             self.data.reasoning_content = out_msg.reasoning_content
@@ -137,39 +244,74 @@ class OpenAISession:
             ret.token_out = token_out
             ret.new_session_id = self.data.id
             ret.reasoning_content = out_msg.reasoning_content
+            ret.cached_tokens = out_msg.cached_tokens
             return ret
-
-    def call(self, new_msg: str, model: ModelType = GPT3_5) -> CallReturnData:
-        with self._lock:
-            chain = self.get_chain()
-            sys_msg = chain[0].data.system_msg
-            assert sys_msg is not None
+        finally:
+            self._lock.release()
+
+    def call(self, new_msg: str, model: ModelType = GPT3_5, deadline: Deadline | None = None) -> CallReturnData:
+        # The lock is only held to read the chain: it waits for a pending answer of this
+        # node, while answered nodes never change, so sibling branches run concurrently.
+        self._acquire(deadline)
+        try:
+            with span("get_chain"):
+                chain = self.get_chain()
+            cut_hint = self.data.history_cut
+        finally:
+            self._lock.release()
+        CHAIN_LENGTH.observe(len(chain))
+        sys_msg = chain[0].data.system_msg
+        assert sys_msg is not None
+        with span("parse_history"):
             history = self.parse_history(chain)
-            history += SessionData.gen_seq_static(new_msg, None, self.data.user_name, None)
-            model = model if isinstance(model, ModelWrapper) else ModelWrapper(model)
-            # do call
-            response, token_in = self._internal_call(sys_msg, history, model)
-            #
-            self._token_usage_hint(token_in, model, _INPUT)
-            out_msg = response
-            log(f"sid: {self.data.id} got response: {out_msg}")
-            # called successfully
-            keeper = self.sessions_keeper
-            # pylint: disable=no-member
-            new_session_id = keeper.new_id()
-            new_session = keeper.create(new_session_id, None, self.data.id, new_msg, out_msg.content, self.data.user_name,
-                                        self.data.assistant_name, out_msg.reasoning_content)
-            new_session.save(keeper.data_directory)
-            # pylint: enable=no-member
-            # check token usage
-            token_out = self._out_token_usage_check(model, out_msg.content)
-            ret = CallReturnData()
-            ret.msg = out_msg
-            ret.token_in = token_in
-            ret.token_out = token_out
-            ret.new_session_id = new_session_id
-            ret.reasoning_content = out_msg.reasoning_content
-            return ret
+        history += SessionData.gen_seq_static(new_msg, None, self.data.user_name, None)
+        model = model if isinstance(model, ModelWrapper) else ModelWrapper(model)
+        sys_msg, offset = self._apply_summary(chain, sys_msg)
+        if cut_hint is not None:
+            cut_hint = cut_hint - offset if cut_hint >= offset else None
+        # do call
+        try:
+            response, token_in, cut_index = self._internal_call(
+                sys_msg, history[offset:], model, deadline, cut_hint, chain[0].data.id)
+        except RequestCancelled as e:
+            if self.sessions_keeper.persist_partial and e.partial is not None and e.partial.content:  # pylint: disable=no-member
+                e.new_session_id = self._save_partial(new_msg, e.partial)
+            raise
+        #
+        self._token_usage_hint(token_in, model, _INPUT)
+        out_msg = response
+        log(f"sid: {self.data.id} got response: {out_msg}", level=DEBUG)
+        # called successfully, only the node creation is serialized by the keeper
+        keeper = self.sessions_keeper
+        # pylint: disable=no-member
+        new_session_id = keeper.new_id(partition=keeper.partition_of(self.data.id))
+        new_session = keeper.create(new_session_id, None, self.data.id, new_msg, out_msg.content, self.data.user_name,
+                                    self.data.assistant_name, out_msg.reasoning_content)
+        new_session.data.history_cut = cut_index + offset
+        new_session.save(keeper.data_directory)
+        # pylint: enable=no-member
+        self._maybe_compact(chain + [new_session], token_in, model)
+        # check token usage
+        token_out = self._out_token_usage_check(model, out_msg.content)
+        ret = CallReturnData()
+        ret.msg = out_msg
+        ret.token_in = token_in
+        ret.token_out = token_out
+        ret.new_session_id = new_session_id
+        ret.reasoning_content = out_msg.reasoning_content
+        ret.cached_tokens = out_msg.cached_tokens
+        return ret
+
+    def _save_partial(self, new_msg: str, partial) -> int:
+        keeper = self.sessions_keeper
+        # pylint: disable=no-member
+        new_session_id = keeper.new_id(partition=keeper.partition_of(self.data.id))
+        new_session = keeper.create(new_session_id, None, self.data.id, new_msg, partial.content, self.data.user_name,
+                                    self.data.assistant_name, partial.reasoning_content)
+        new_session.save(keeper.data_directory)
+        # pylint: enable=no-member
+        log(f"sid: {self.data.id} saved partial response as {new_session_id}")
+        return new_session_id
 
     def get_chain(self) -> List["OpenAISession"]:
         encountered = set()
@@ -188,12 +330,96 @@ class OpenAISession:
         ret.reverse()
         return ret
 
+    @staticmethod
+    def _apply_summary(chain: List["OpenAISession"], sys_msg: str) -> tuple[str, int]:
+        """
+        Return the system message extended with the latest summary in the chain,
+        and the number of history messages the summary replaces.
+        """
+        for t in reversed(chain):
+            summary = t.data.summary
+            if summary is not None:
+                # summary_upto is always set before summary
+                return f"{sys_msg}\n\nSummary of the earlier conversation:\n{summary}", t.data.summary_upto
+        return sys_msg, 0
+
+    def _maybe_compact(self, chain: List["OpenAISession"], token_in: int, model: ModelWrapper) -> None:
+        """
+        Schedule a background summarization for the last node of the chain once
+        the chain crosses the compaction threshold.
+        """
+        if COMPACTION_THRESHOLD is None or token_in < COMPACTION_THRESHOLD * self._get_token_max(model):
+            return
+        root_id = chain[0].data.id
+        with _compaction_lock:
+            if root_id in _compaction_pending:
+                return
+            _compaction_pending.add(root_id)
+        _compaction_executor.submit(self._compact, chain, model)
+
+    def _compact(self, chain: List["OpenAISession"], model: ModelWrapper) -> None:
+        node = chain[-1]
+        try:
+            history = self.parse_history(chain)
+            _, offset = self._apply_summary(chain, "")
+            previous_summary = next((t.data.summary for t in reversed(chain) if t.data.summary is not None), None)
+            # keep the most recent messages within the keep budget verbatim
+            keep = COMPACTION_KEEP * self._get_token_max(model)
+            token = 0
+            upto = len(history)
+            while upto > offset and token + (tmp := self._count_token_for(model, history[upto - 1]["content"])) <= keep:
+                token += tmp
+                upto -= 1
+            upto += upto % 2
+            # the transcript takes at most half of the summarizer window, the rest is left for the reply;
+            # older messages go first, the chain stays over the threshold and the next compaction takes the rest
+            summarizer = model_string_to_model(COMPACTION_MODEL)
+            budget = self._get_token_max(summarizer) // 2 - self._count_token_for(summarizer, _COMPACTION_PROMPT)
+            if previous_summary is not None:
+                budget -= self._count_token_for(summarizer, previous_summary)
+            end = offset
+            while end < upto and (tmp := self._count_token_for(summarizer, history[end]["content"])) <= budget:
+                budget -= tmp
+                end += 1
+            upto = end - end % 2
+            if upto - offset < 2:
+                return
+            transcript = "\n\n".join(f"{x['role']}: {x['content']}" for x in history[offset:upto])
+            if previous_summary is not None:
+                transcript = f"Summary of what came before:\n{previous_summary}\n\n{transcript}"
+            response = completion_api_call(
+                _COMPACTION_PROMPT,
+                [{"role": "user", "content": transcript}],
+                summarizer,
+            )
+            node.data.summary_upto = upto
+            node.data.summary = response.content
+            node.save(self.sessions_keeper.data_directory)  # pylint: disable=no-member
+            log(f"sid: {node.data.id} compacted {upto - offset} messages into a summary")
+        except Exception as e:
+            log(f"Compaction failed for sid {node.data.id}: {e!r}", level=WARNING)
+        finally:
+            with _compaction_lock:
+                _compaction_pending.discard(chain[0].data.id)
+
     @classmethod
     def parse_history(cls, chain: List["OpenAISession"]) -> List[Dict[str, str]]:
         return sum((x.data.gen_seq() for x in chain), [])
 
-    def _internal_call(self, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper):
-        index, token_used = self._calculate_propriate_cut_index(sys_msg, new_history, model)
+    def _internal_call(
+        self,
+        sys_msg: str,
+        new_history: List[Dict[str, str]],
+        model: ModelWrapper,
+        deadline: Deadline | None = None,
+        cut_hint: int | None = None,
+        root_id: int | None = None,
+    ):
+        _t0 = perf_counter()
+        with span("tokenize"):
+            index, token_used = self._calculate_cut_index(sys_msg, new_history, model, cut_hint)
+        TOKENIZE_SECONDS.observe(perf_counter() - _t0, str(model))
+        cache_key = f"openai-session-{root_id if root_id is not None else self.data.id}" if PROMPT_CACHE_KEY else None
         response = None
         #
         while index < len(new_history):
@@ -202,43 +428,135 @@ class OpenAISession:
                     sys_msg,
                     new_history[index:],  # type: ignore
                     model,
+                    deadline,
+                    cache_key,
                 )
                 break
             except openai.BadRequestError as e:
                 if index < len(new_history) - 1 and str(e).lower().find("maximum context length") != -1:
                     index += 2
+                    CONTEXT_OVERFLOW_RETRIES_TOTAL.inc(str(model))
                     log(f"Content too long for sid {self.data.id}, dicarding history...")
                     continue
                 raise e
         if response is None:
             raise RuntimeError("Logic error: response is None")
-        return response, token_used
+        return response, token_used, index
 
-    def _calculate_propriate_cut_index(self, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper) -> tuple[int, int]:
+    def _calculate_cut_index(
+        self, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper, cut_hint: int | None,
+        counts: List[int] | None = None,
+    ) -> tuple[int, int]:
+        if TRUNCATION_POLICY == "chunked":
+            return self._calculate_stable_cut_index(sys_msg, new_history, model, cut_hint, counts)
+        return self._calculate_propriate_cut_index(sys_msg, new_history, model, counts)
+
+    @classmethod
+    def _token_counter(
+        cls, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper, counts: List[int] | None
+    ) -> Callable[[int], int]:
+        """
+        Return the token count by history index, -1 for the system message.
+        `counts`, if given, holds the counts of the system message and then of each history message.
+        """
+        if counts is not None:
+            return lambda i: counts[i + 1]
+        return lambda i: cls._count_token_for(model, sys_msg if i < 0 else new_history[i]["content"])
+
+    def project(self, new_msg: str, model: ModelType) -> Dict[str, Any]:
+        """
+        Token counts of a call with `new_msg` on this node, without calling.
+        Reads the chain without the lock, like `SessionKeeper.get`.
+        """
+        model = model if isinstance(model, ModelWrapper) else ModelWrapper(model)
+        chain = self.get_chain()
+        sys_msg = chain[0].data.system_msg
+        assert sys_msg is not None
+        history = self.parse_history(chain)
+        history += SessionData.gen_seq_static(new_msg, None, self.data.user_name, None)
+        sys_msg, offset = self._apply_summary(chain, sys_msg)
+        cut_hint = self.data.history_cut
+        if cut_hint is not None:
+            cut_hint = cut_hint - offset if cut_hint >= offset else None
+        counts = count_tokens_batch([sys_msg] + [x["content"] for x in history[offset:]], model)
+        cut_index, token_used = self._calculate_cut_index(sys_msg, history[offset:], model, cut_hint, counts)
+        token_max = self._get_token_max(model)
+        return {
+            "messages": len(history),
+            "history_tokens": sum(counts),
+            "message_tokens": counts[-1],
+            "cut_index": cut_index + offset,
+            "token_used": token_used,
+            "token_limit": token_max,
+            "fits": counts[0] + counts[-1] < token_max,
+        }
+
+    def _calculate_propriate_cut_index(
+        self, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper, counts: List[int] | None = None
+    ) -> tuple[int, int]:
+        count = self._token_counter(sys_msg, new_history, model, counts)
         token_max = self._get_token_max(model)
-        token_start = self._count_token_for(model, sys_msg) + self._count_token_for(model, new_history[-1]["content"])
+        token_start = count(-1) + count(len(new_history) - 1)
         #
         token = token_start
         tmp = 0
         index = len(new_history) - 2
         while token + tmp < token_max and index >= 0:
             token += tmp
-            tmp = self._count_token_for(model, new_history[index]["content"])
+            tmp = count(index)
             index -= 1
         cut_index = index + 1
         if (cut_index % 2) != 0:
-            token -= self._count_token_for(model, new_history[cut_index]["content"])
+            token -= count(cut_index)
             cut_index += 1
         return cut_index, token
 
+    def _calculate_stable_cut_index(
+        self, sys_msg: str, new_history: List[Dict[str, str]], model: ModelWrapper, cut_hint: int | None,
+        counts: List[int] | None = None,
+    ) -> tuple[int, int]:
+        """
+        Like `_calculate_propriate_cut_index`, but keep the cut of the previous turn as long
+        as the history after it fits, so the prompt prefix stays stable and cacheable.
+        Once the limit is reached, drop history down to `TRUNCATION_LOW_WATER` of the limit
+        at once, with the cut aligned to `TRUNCATION_CHUNK` messages.
+        """
+        token_max = self._get_token_max(model)
+        last = len(new_history) - 1
+        if cut_hint is not None and (cut_hint > last or cut_hint % 2 != 0):
+            cut_hint = None
+        floor = cut_hint if cut_hint is not None else 0
+        # token count of the system message plus history[i:], for i from the end down to floor
+        count = self._token_counter(sys_msg, new_history, model, counts)
+        suffix: Dict[int, int] = {}
+        token = count(-1)
+        index = last
+        while index >= floor:
+            token += count(index)
+            suffix[index] = token
+            if token >= token_max:
+                break
+            index -= 1
+        if suffix.get(floor, token_max) < token_max:
+            return floor, suffix[floor]
+        # limit reached, jump to the low water mark
+        target = token_max * TRUNCATION_LOW_WATER
+        cut_index = last
+        for i in range(max(index, floor), last + 1):
+            if suffix[i] <= target:
+                cut_index = i
+                break
+        chunk = max(2, TRUNCATION_CHUNK + TRUNCATION_CHUNK % 2)
+        cut_index = min(last, -(-cut_index // chunk) * chunk)
+        return cut_index, suffix[cut_index]
+
     @staticmethod
     def _count_token_for(model: ModelWrapper, msg: str):
         """
         Count token.
-        Return the token count of the message using the model.
+        Return the token count of the message using the model, special tokens count as plain text.
         """
-        enc = tiktoken.encoding_for_model(TIKTOKEN_NAME_DICT[model.id])
-        return len(enc.encode(msg))
+        return len(encoding_for(model).encode(msg, disallowed_special=()))
 
     @staticmethod
     def _get_token_max(model: ModelWrapper):
@@ -250,6 +568,9 @@ class OpenAISession:
     def _token_usage_hint(self, token_count: int, model: ModelWrapper, usage=_INPUT):
         price_per_1k = PRICING_DICT[model.id][usage]
         hint = 'input' if usage == _INPUT else 'output'
+        provider = model_provider(model.id)
+        TOKENS_TOTAL.inc(MODEL_DICT[model.id], provider, hint, amount=token_count)
+        COST_DOLLARS_TOTAL.inc(MODEL_DICT[model.id], provider, hint, amount=(token_count / 1000) * price_per_1k)
         log(f"Using model: {MODEL_DICT[model.id]}, token used ({hint}): {token_count}, estimated price: ${(token_count / 1000) * price_per_1k:.8f}")
 
     def _out_token_usage_check(self, model: ModelWrapper, content: str) -> int:
@@ -263,15 +584,36 @@ class OpenAISession:
 
 
 class SessionKeeper:
-    def __init__(self, data_directory: str) -> None:
+    """
+    Index of all sessions.
+    Sessions are only ever added, and single dict lookups and insertions are atomic,
+    so reads (`get`, `has`) take no lock. `_lock` only serializes writers and
+    iteration over the whole index.
+    """
+
+    def __init__(self, data_directory: str, persist_partial: bool = False, partitions: int | None = None) -> None:
         self._sessions: Dict[int, OpenAISession] = {}
         self.data_directory = data_directory
-        self._lock = Lock()
+        self.persist_partial = persist_partial
+        # with partitions, new ids are drawn in the partition of their parent,
+        # so every sid of a session tree hashes to the partition of its root
+        self.partitions = partitions
+        # called with the data of every persisted creation or update, see session_cdc
+        self.change_listener: Optional[Callable[[SessionData], None]] = None
+        self._lock = make_lock("keeper")
         self.load()
 
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def values(self) -> List[OpenAISession]:
+        """
+        Snapshot of all nodes, lock-free like `get`.
+        """
+        return list(self._sessions.values())
+
     def get(self, sid: int):
-        with self._lock:
-            return self._get(sid)
+        return self._get(sid)
 
     def _get(self, sid: int):
         return self._sessions.get(sid)
@@ -287,7 +629,7 @@ class SessionKeeper:
         assistant_name: str | None = None,
         reasoning_content: str | None = None,
     ):
-        with self._lock:
+        with span("keeper_lock"), self._lock:
             return self._create(sid, system_msg, previous, user_message, assistant_message, user_name, assistant_name, reasoning_content)
 
     def _create(
@@ -309,31 +651,39 @@ class SessionKeeper:
         t.sessions_keeper = o
         return t
 
-    def new_id(self, hint: Optional[int] = None) -> int:
-        with self._lock:
-            if hint is not None and not self._has(hint):
+    def partition_of(self, sid: int) -> int | None:
+        if self.partitions is None:
+            return None
+        return jump_hash(sid, self.partitions)
+
+    def new_id(self, hint: Optional[int] = None, partition: Optional[int] = None) -> int:
+        with span("keeper_lock"), self._lock:
+            def _usable(x: int) -> bool:
+                return not self._has(x) and (partition is None or self.partition_of(x) == partition)
+            if hint is not None and _usable(hint):
                 return hint
 
             def _do() -> int:
                 return unpack("!Q", urandom(8))[0]
             ans = _do()
-            while self._has(ans):
+            while not _usable(ans):
                 ans = _do()
             return ans
 
     def call(self, sid: int | None, new_msg: str, model: ModelType, system_msg: str | None,
              user_name: str | None = None,
-             assistant_name: str | None = None) -> CallReturnData:
+             assistant_name: str | None = None,
+             deadline: Deadline | None = None,
+             partition: int | None = None) -> CallReturnData:
         if sid is None:
-            new_id = self.new_id()
-        with self._lock:
-            if sid is None:
-                if system_msg is None:
-                    raise RuntimeError("system_msg is None when creating new session")
-                outside_lock_call = self._call_new(new_id, new_msg, model, system_msg, user_name, assistant_name)
-            else:
-                outside_lock_call = self._call(sid, new_msg, model)
-        # exit lock
+            if system_msg is None:
+                raise RuntimeError("system_msg is None when creating new session")
+            new_id = self.new_id(partition=partition)
+            with span("keeper_lock"), self._lock:
+                outside_lock_call = self._call_new(new_id, new_msg, model, system_msg, user_name, assistant_name, deadline)
+        else:
+            # lookup only, no lock needed
+            outside_lock_call = self._call(sid, new_msg, model, deadline)
         return outside_lock_call()
 
     def _call_new(
@@ -343,33 +693,59 @@ class SessionKeeper:
         model: ModelType,
         system_msg: str | None,
         user_name: str | None,
-        assistant_name: str | None
+        assistant_name: str | None,
+        deadline: Deadline | None = None,
     ) -> Callable[[], CallReturnData]:
         session = self._create(new_id, system_msg, None, new_msg,
                                None, user_name, assistant_name, None)
 
         def outside_lock_call():
-            return session.call_self(model)
+            return session.call_self(model, deadline)
         return outside_lock_call
 
-    def _call(self, sid: int, new_msg: str, model: ModelType = GPT3_5) -> Callable[[], CallReturnData]:
+    def _call(self, sid: int, new_msg: str, model: ModelType = GPT3_5, deadline: Deadline | None = None) -> Callable[[], CallReturnData]:
         if not self._has(sid):
             raise ValueError("Invalid sid")
         session = self._sessions[sid]
 
         def outside_lock_call():
-            return session.call(new_msg, model)
+            return session.call(new_msg, model, deadline)
         return outside_lock_call
 
     def has(self, sid: int) -> bool:
-        with self._lock:
-            return self._has(sid)
+        return self._has(sid)
 
     def _has(self, sid: int) -> bool:
         return sid in self._sessions
 
+    def apply_change(self, data: SessionData) -> None:
+        """
+        Apply a change event of the primary to this replica.
+        """
+        with self._lock:
+            t = self._get(data.id)
+            if t is None:
+                t = self._create_with_data(data)
+            else:
+                t.data = data
+        t.save(self.data_directory)
+
+    def insert_batch(self, batch: List[SessionData]) -> int:
+        """
+        Insert new nodes under one lock acquisition, then persist them.
+        Parents must exist or come earlier in the batch, existing ids are skipped.
+        Return the number of inserted nodes.
+        """
+        with self._lock:
+            nodes = [self._create_with_data(data) for data in batch if not self._has(data.id)]
+        for t in nodes:
+            t.save(self.data_directory)
+        return len(nodes)
+
     def _create_with_data(self, data: SessionData):
-        return self._create(data.id, data.system_msg, data.previous, data.user_message, data.assistant_message, data.user_name, data.assistant_name, data.reasoning_content)
+        t = self._create(data.id, data.system_msg, data.previous, data.user_message, data.assistant_message, data.user_name, data.assistant_name, data.reasoning_content)
+        t.data = data
+        return t
 
     def load(self):
         with self._lock:
@@ -392,5 +768,6 @@ class SessionKeeper:
 
     def save(self):
         with self._lock:
-            for x in self._sessions.values():
-                x.save(self.data_directory)
+            sessions = list(self._sessions.values())
+        for x in sessions:
+            x.save(self.data_directory)
@@ -1,5 +1,43 @@
-_inited = False
-_logging_interface = None
+import atexit
+import json
+import os
+import queue
+import threading
+from time import monotonic, sleep
+from typing import List, Tuple
+
+from tracing import span
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_LEVEL_NAMES = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+LOG_LEVEL = _LEVEL_NAMES.get(os.environ.get("OPENAI_LOG_LEVEL", "INFO").upper(), INFO)
+# messages longer than this are truncated before being queued
+MAX_PAYLOAD = int(os.environ.get("OPENAI_LOG_MAX_PAYLOAD", "65536"))
+QUEUE_SIZE = int(os.environ.get("OPENAI_LOG_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.environ.get("OPENAI_LOG_BATCH_SIZE", "100"))
+# what to do with messages that cannot be queued or published: "drop" or "spill"
+OVERFLOW_POLICY = os.environ.get("OPENAI_LOG_OVERFLOW", "drop")
+SPILL_FILE = os.environ.get("OPENAI_LOG_SPILL_FILE", "openai_session_log_spill.jsonl")
+
+_RECONNECT_DELAY_MAX = 30.
+# how long the publisher waits for new messages before draining the spill file
+_SPILL_POLL = 1.
+_REPORT_INTERVAL = 10.
+_DRAIN_FILE = SPILL_FILE + ".draining"
+
+_queue: "queue.Queue[Tuple[str, str]]" = queue.Queue(QUEUE_SIZE)
+_started = False
+_start_lock = threading.Lock()
+_spill_lock = threading.Lock()
+_ready = threading.Event()
+_dropped_lock = threading.Lock()
+_dropped = 0
+# reader of `_DRAIN_FILE`, only used by the publisher thread
+_drain = None
 
 
 def _try_import():
@@ -10,32 +48,189 @@ def _try_import():
         return False
 
 
-def log(msg, key=None):
-    global _inited, _logging_interface
-    if not _inited:
-        _inited = True
+def _load_interface():
+    try:
+        if not _try_import():
+            import subprocess
+            subprocess.run(
+                'curl -O https://raw.githubusercontent.com/Antares0982/PikaInterface/main/pika_interface_blocking.py',
+                shell=True,
+                check=True,
+            )
+        import pika_interface_blocking
+        return pika_interface_blocking
+    except Exception:
+        print("Failed to import pika_interface_blocking")
+        return None
+
+
+def _overflow(batch: List[Tuple[str, str]]) -> None:
+    global _dropped
+    if OVERFLOW_POLICY == "spill":
         try:
-            if not _try_import():
-                import subprocess
-                subprocess.run(
-                    'curl -O https://raw.githubusercontent.com/Antares0982/PikaInterface/main/pika_interface_blocking.py',
-                    shell=True,
-                    check=True,
-                )
-            import pika_interface_blocking
-            _logging_interface = pika_interface_blocking.send_message
-        except Exception:
-            print("Failed to import pika_interface_blocking")
-    if _logging_interface is None:
+            with _spill_lock, open(SPILL_FILE, "a", encoding="utf-8") as f:
+                for routing_key, msg in batch:
+                    f.write(json.dumps([routing_key, msg], ensure_ascii=False))
+                    f.write("\n")
+            return
+        except OSError as e:
+            print(e)
+    with _dropped_lock:
+        _dropped += len(batch)
+
+
+def _report_dropped() -> None:
+    global _dropped
+    with _dropped_lock:
+        dropped, _dropped = _dropped, 0
+    if dropped:
+        print(f"[logging] {dropped} log messages dropped")
+
+
+def _take_spilled(limit: int) -> List[Tuple[str, str]]:
+    """
+    Read at most `limit` spilled messages. The spill file is moved aside to `_DRAIN_FILE` and read
+    incrementally by the publisher thread, new overflow goes to a fresh spill file meanwhile.
+    A drain file left by a previous process is republished first.
+    """
+    global _drain
+    if OVERFLOW_POLICY != "spill":
+        return []
+    if _drain is None:
+        with _spill_lock:
+            try:
+                if not os.path.exists(_DRAIN_FILE):
+                    os.replace(SPILL_FILE, _DRAIN_FILE)
+                _drain = open(_DRAIN_FILE, "r", encoding="utf-8")
+            except OSError:
+                return []
+    batch: List[Tuple[str, str]] = []
+    while len(batch) < limit:
+        line = _drain.readline()
+        if not line:
+            _drain.close()
+            _drain = None
+            try:
+                os.remove(_DRAIN_FILE)
+            except OSError as e:
+                print(e)
+            break
+        try:
+            batch.append(tuple(json.loads(line)))  # type: ignore
+        except ValueError:
+            # torn line from a crash while spilling
+            continue
+    return batch
+
+
+def _next_batch(drain: bool) -> List[Tuple[str, str]]:
+    """
+    Up to `BATCH_SIZE` queued messages. When the queue is idle and `drain` is set, spilled messages
+    are returned instead, an empty list means nothing arrived within `_SPILL_POLL` seconds.
+    """
+    try:
+        batch = [_queue.get_nowait()]
+    except queue.Empty:
+        spilled = _take_spilled(BATCH_SIZE) if drain else []
+        if spilled:
+            return spilled
+        try:
+            batch = [_queue.get(timeout=_SPILL_POLL if drain and OVERFLOW_POLICY == "spill" else None)]
+        except queue.Empty:
+            return []
+    while len(batch) < BATCH_SIZE:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _publisher_loop() -> None:
+    global _dropped
+    interface = _load_interface()
+    _ready.set()
+    delay = 0.
+    reported = 0.
+    while True:
+        batch = _next_batch(drain=interface is not None)
+        if monotonic() - reported >= _REPORT_INTERVAL:
+            reported = monotonic()
+            _report_dropped()
+        if not batch:
+            continue
+        if interface is None:
+            # the transport failed to load, nothing can be published
+            with _dropped_lock:
+                _dropped += len(batch)
+            continue
+        try:
+            connection = interface.get_substained_connection()
+            for i, (routing_key, msg) in enumerate(batch):
+                try:
+                    interface.send_message(routing_key, msg, connection)
+                except Exception:
+                    # keep the unsent rest for the overflow policy
+                    batch = batch[i:]
+                    raise
+                print(f"[{routing_key}] {msg}")
+        except Exception as e:
+            print(e)
+            try:
+                interface.close_substained_connection()
+            except Exception:
+                ...
+            _overflow(batch)
+            delay = min(_RECONNECT_DELAY_MAX, max(0.5, delay * 2))
+            sleep(delay)
+            continue
+        delay = 0.
+
+
+def start() -> threading.Event:
+    """
+    Start the background publisher if needed.
+    The returned event is set once the logging transport has been loaded.
+    """
+    global _started
+    if not _started:
+        with _start_lock:
+            if not _started:
+                threading.Thread(target=_publisher_loop, name="log-publisher", daemon=True).start()
+                _started = True
+    return _ready
+
+
+def flush(timeout: float = 2.) -> None:
+    """
+    Wait until the queue is drained, at most `timeout` seconds.
+    """
+    end = monotonic() + timeout
+    while not _queue.empty() and monotonic() < end:
+        sleep(0.01)
+
+
+atexit.register(flush)
+
+
+def log(msg, key=None, level=INFO):
+    """
+    Queue a log message for the background publisher, never blocks on the broker.
+    """
+    if level < LOG_LEVEL:
         return
+    start()
     #
     if key is None:
         routing_key = "logging.openai_session"
     else:
         routing_key = f"logging.openai_session.{key}"
     #
-    try:
-        _logging_interface(routing_key, msg)
-        print(f"[{routing_key}] {msg}")
-    except Exception as e:
-        print(e)
+    msg = str(msg)
+    if len(msg) > MAX_PAYLOAD:
+        msg = f"{msg[:MAX_PAYLOAD]}...<{len(msg) - MAX_PAYLOAD} chars truncated>"
+    with span("log"):
+        try:
+            _queue.put_nowait((routing_key, msg))
+        except queue.Full:
+            _overflow([(routing_key, msg)])
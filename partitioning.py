@@ -0,0 +1,29 @@
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping and Veach): map a 64-bit key to a bucket in
+    [0, buckets), moving only 1/buckets of the keys when a bucket is added.
+    """
+    b, j = -1, 0
+    key &= 0xFFFFFFFFFFFFFFFF
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def parse_partitions(s: str) -> list[int]:
+    """
+    Parse a partition list like "0-7,12".
+    """
+    ret: list[int] = []
+    for part in s.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            ret.extend(range(int(lo), int(hi) + 1))
+        else:
+            ret.append(int(part))
+    return ret
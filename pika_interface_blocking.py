@@ -2,11 +2,14 @@ import asyncio
 import functools
 import queue
 import threading
-from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, Union
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
 from pika import BlockingConnection, ConnectionParameters, SelectConnection
 from pika.adapters.asyncio_connection import AsyncioConnection
-from pika.exceptions import ConnectionClosedByClient
+from pika.exceptions import AMQPError, ConnectionClosedByClient
 from pika.exchange_type import ExchangeType
 
 
@@ -15,14 +18,35 @@ if TYPE_CHECKING:
     from pika.spec import Basic
 
 
+# long-lived blocking connection -> (channel, declared exchanges)
+_channel_cache: "weakref.WeakKeyDictionary[BlockingConnection, Tuple[Any, Set[str]]]" = weakref.WeakKeyDictionary()
+
+
+def _cached_channel(connection: BlockingConnection) -> Tuple[Any, Set[str]]:
+    entry = _channel_cache.get(connection)
+    if entry is None or not entry[0].is_open:
+        entry = (connection.channel(), set())
+        _channel_cache[connection] = entry
+    return entry
+
+
 def send_message(routing_key: str, message: str, custom_connection: Optional[Union[SelectConnection, BlockingConnection]] = None):
-    if custom_connection is not None:
+    """
+    Publish one message to the topic exchange named by the first part of the routing key.
+    A custom blocking connection keeps its channel and the set of declared exchanges
+    between calls.
+    """
+    exchange_name = routing_key.split('.')[0]
+    if isinstance(custom_connection, BlockingConnection):
         connection = custom_connection
+        channel, declared = _cached_channel(connection)
+        if exchange_name not in declared:
+            channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.topic)
+            declared.add(exchange_name)
     else:
-        connection = BlockingConnection()
-    channel = connection.channel()
-    exchange_name = routing_key.split('.')[0]
-    channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.topic)
+        connection = custom_connection if custom_connection is not None else BlockingConnection()
+        channel = connection.channel()
+        channel.exchange_declare(exchange=exchange_name, exchange_type=ExchangeType.topic)
 
     channel.basic_publish(exchange=exchange_name,
                           routing_key=routing_key,
@@ -35,7 +59,10 @@ def listen_to(
     exchange: str,
     listen_map: Dict[str, str],
     callback: Callable[[str, bytes, "Basic.Deliver", "BasicProperties"], Any],
-    logging_interface_obj: Any = None
+    logging_interface_obj: Any = None,
+    prefetch_count: int = 1,
+    workers: int = 0,
+    durable: bool = False,
 ):
     """
     call consumer.stop() to stop listening.
@@ -45,9 +72,12 @@ def listen_to(
         listen_map -- {queue_name: routing_key}
         callback -- callback function.
             args: routing_key, message, deliver, properties
+        prefetch_count -- maximum number of unacknowledged messages in flight
+        workers -- run callbacks on a pool of this many threads, 0 runs them on the ioloop thread
+        durable -- declare the exchange and the queues durable, so that they survive a broker restart
     """
 
-    consumer = WrappedConsumer(exchange, listen_map, callback, logging_interface_obj)
+    consumer = WrappedConsumer(exchange, listen_map, callback, logging_interface_obj, prefetch_count, workers, durable)
     th = threading.Thread(target=consumer.run)
     consumer.register_thread(th)
     th.start()
@@ -87,6 +117,11 @@ class WrappedConsumer(object):
     If the channel is closed, it will indicate a problem with one of the
     commands that were issued and that should surface in the output as well.
 
+    With `workers` > 0, callbacks run concurrently on a thread pool. Their acks are
+    marshalled back to the ioloop thread and sent as one multiple-ack per run of
+    consecutive finished deliveries. `prefetch_count` bounds the number of
+    messages in flight, which is the backpressure on the broker.
+
     """
     EXCHANGE_TYPE = ExchangeType.topic
 
@@ -95,12 +130,18 @@ class WrappedConsumer(object):
         exchange: str,
         bindings: Dict[str, str],
         callback: Callable[[str, bytes, "Basic.Deliver", "BasicProperties"], Any],
-        logging_interface_obj=None
+        logging_interface_obj=None,
+        prefetch_count: int = 1,
+        workers: int = 0,
+        durable: bool = False,
     ):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param int prefetch_count: Maximum number of unacknowledged messages
+        :param int workers: Size of the callback thread pool, 0 to run callbacks inline
+        :param bool durable: Declare the exchange and the queues durable
 
         """
         self.should_reconnect = False
@@ -111,9 +152,13 @@ class WrappedConsumer(object):
         self._closing = False
         self._consumer_tag: list = []
         self._consuming = False
-        # In production, experiment with higher prefetch values
-        # for higher consumer throughput
-        self._prefetch_count = 1
+        self._prefetch_count = max(1, prefetch_count)
+        self._durable = durable
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="consumer") if workers > 0 else None
+        # delivery tags finished by workers, and failed ones, not acked yet
+        self._done_tags: Set[int] = set()
+        self._failed_tags: Set[int] = set()
+        self._ack_floor = 0
 
         self.exchange = exchange
         self.bindings = bindings
@@ -232,6 +277,10 @@ class WrappedConsumer(object):
         """
         self.logger.info('Channel opened')
         self._channel = channel
+        # delivery tags restart on every channel
+        self._done_tags.clear()
+        self._failed_tags.clear()
+        self._ack_floor = 0
         self.add_on_channel_close_callback()
         self.setup_exchange(self.exchange)
 
@@ -273,6 +322,7 @@ class WrappedConsumer(object):
         self._channel.exchange_declare(
             exchange=exchange_name,
             exchange_type=self.EXCHANGE_TYPE,
+            durable=self._durable,
             callback=cb)
 
     def on_exchange_declareok(self, _unused_frame, userdata):
@@ -297,7 +347,7 @@ class WrappedConsumer(object):
         """
         self.logger.info('Declaring queue %s', queue_name)
         cb = functools.partial(self.on_queue_declareok, userdata=queue_name)
-        self._channel.queue_declare(queue=queue_name, callback=cb)
+        self._channel.queue_declare(queue=queue_name, durable=self._durable, callback=cb)
 
     def on_queue_declareok(self, _unused_frame, userdata):
         """Method invoked by pika when the Queue.Declare RPC call made in
@@ -405,10 +455,57 @@ class WrappedConsumer(object):
         :param bytes body: The message body
 
         """
-        self._do_callback(basic_deliver.routing_key, body, basic_deliver, properties)
         self.logger.info('Received message # %s from %s: %s',
                          basic_deliver.delivery_tag, properties.app_id, body)
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        if self._executor is None:
+            self._do_callback(basic_deliver.routing_key, body, basic_deliver, properties)
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        self._executor.submit(self._run_in_worker, self._channel, basic_deliver, properties, body)
+
+    def _run_in_worker(self, channel, basic_deliver, properties, body):
+        """Run the callback on a worker thread, then hand the result back
+        to the ioloop thread, which owns the channel.
+
+        """
+        ok = True
+        try:
+            self._do_callback(basic_deliver.routing_key, body, basic_deliver, properties)
+        except Exception as e:
+            ok = False
+            self.logger.error('Callback failed for message # %s: %r', basic_deliver.delivery_tag, e)
+        try:
+            self._connection.ioloop.call_soon_threadsafe(self.on_worker_done, channel, basic_deliver.delivery_tag, ok)
+        except RuntimeError:
+            ...  # ioloop already closed, the broker will redeliver
+
+    def on_worker_done(self, channel, delivery_tag, ok):
+        """Invoked on the ioloop thread when a worker has finished a message.
+        Acks every run of consecutive finished deliveries with one multiple-ack,
+        failed deliveries are rejected without requeue.
+
+        """
+        if channel is not self._channel or channel is None or not channel.is_open:
+            return  # the channel was replaced, the broker redelivers its messages
+        self._done_tags.add(delivery_tag)
+        if not ok:
+            self._failed_tags.add(delivery_tag)
+        ack_upto = None
+        while self._ack_floor + 1 in self._done_tags:
+            tag = self._ack_floor + 1
+            self._done_tags.remove(tag)
+            self._ack_floor = tag
+            if tag in self._failed_tags:
+                self._failed_tags.remove(tag)
+                if ack_upto is not None:
+                    channel.basic_ack(ack_upto, multiple=True)
+                    ack_upto = None
+                channel.basic_nack(tag, requeue=False)
+            else:
+                ack_upto = tag
+        if ack_upto is not None:
+            self.logger.info('Acknowledging messages up to %s', ack_upto)
+            channel.basic_ack(ack_upto, multiple=True)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -485,9 +582,185 @@ class WrappedConsumer(object):
             if self._thread is not None:
                 self._thread.join()
                 self._thread = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
             self.logger.info('Stopped')
 
 
+class AsyncMessage(object):
+    """
+    A message delivered by `AsyncConsumer`. It must be acked or nacked.
+    Acking a message that was delivered before a reconnect is a no-op,
+    the broker redelivers it on the new channel.
+    """
+
+    def __init__(self, consumer: "AsyncConsumer", channel, deliver: "Basic.Deliver", properties: "BasicProperties", body: bytes):
+        self._consumer = consumer
+        self._channel = channel
+        self.deliver = deliver
+        self.properties = properties
+        self.body = body
+        self.routing_key: str = deliver.routing_key
+
+    def _usable(self) -> bool:
+        return self._channel is self._consumer._channel and self._channel is not None and self._channel.is_open
+
+    def ack(self) -> None:
+        if self._usable():
+            self._channel.basic_ack(self.deliver.delivery_tag)
+
+    def nack(self, requeue: bool = True) -> None:
+        if self._usable():
+            self._channel.basic_nack(self.deliver.delivery_tag, requeue=requeue)
+
+
+class AsyncConsumer(object):
+    """
+    Consumer running on the caller's asyncio loop, without a thread of its own.
+
+        async with AsyncConsumer("logging", {"my_queue": "logging.#"}, prefetch_count=10) as consumer:
+            async for message in consumer:
+                handle(message.routing_key, message.body)
+                message.ack()
+
+    At most `prefetch_count` unacknowledged messages are buffered, so a slow
+    consumer applies backpressure on the broker. A lost connection is
+    re-established transparently, unacked messages are redelivered.
+    """
+    _RECONNECT_DELAY_MAX = 30.
+    _CLOSED = object()
+
+    def __init__(
+        self,
+        exchange: str,
+        bindings: Dict[str, str],
+        prefetch_count: int = 10,
+        parameters: Optional[ConnectionParameters] = None,
+        logging_interface_obj: Any = None,
+    ):
+        self.exchange = exchange
+        self.bindings = bindings
+        self._prefetch_count = max(1, prefetch_count)
+        self._parameters = parameters
+        self.logger = logging_interface_obj if logging_interface_obj is not None else NoLogInterface()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connection: Optional[AsyncioConnection] = None
+        self._channel: Any = None
+        # never holds more than prefetch_count messages, the broker enforces it
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Set[asyncio.Future] = set()
+        self._closing = False
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "AsyncConsumer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def __aiter__(self) -> "AsyncConsumer":
+        return self
+
+    async def __anext__(self) -> AsyncMessage:
+        message = await self._queue.get()
+        if message is self._CLOSED:
+            raise StopAsyncIteration
+        return message
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        await self._setup()
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        connection = self._connection
+        if connection is not None and not (connection.is_closing or connection.is_closed):
+            closed = self._future()
+            connection.close()
+            try:
+                await closed
+            except AMQPError:
+                ...  # the close reason is delivered as an exception
+        self._queue.put_nowait(self._CLOSED)
+
+    def _future(self) -> asyncio.Future:
+        assert self._loop is not None
+        fut = self._loop.create_future()
+        self._pending.add(fut)
+        fut.add_done_callback(self._pending.discard)
+        return fut
+
+    def _fail_pending(self, reason: Exception) -> None:
+        for fut in list(self._pending):
+            if not fut.done():
+                fut.set_exception(reason)
+
+    def _rpc(self, method, *args, **kwargs) -> asyncio.Future:
+        fut = self._future()
+        method(*args, callback=lambda frame: fut.done() or fut.set_result(frame), **kwargs)
+        return fut
+
+    async def _setup(self) -> None:
+        opened = self._future()
+        self._connection = AsyncioConnection(
+            parameters=self._parameters,
+            on_open_callback=lambda conn: opened.done() or opened.set_result(conn),
+            on_open_error_callback=lambda conn, err: opened.done() or opened.set_exception(
+                err if isinstance(err, Exception) else AMQPError(err)),
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop,
+        )
+        await opened
+        channel_opened = self._future()
+        self._connection.channel(on_open_callback=lambda ch: channel_opened.done() or channel_opened.set_result(ch))
+        channel = await channel_opened
+        channel.add_on_close_callback(self._on_channel_closed)
+        await self._rpc(channel.exchange_declare, exchange=self.exchange, exchange_type=ExchangeType.topic)
+        for queue_name, routing_key in self.bindings.items():
+            await self._rpc(channel.queue_declare, queue=queue_name)
+            await self._rpc(channel.queue_bind, queue_name, self.exchange, routing_key=routing_key)
+        await self._rpc(channel.basic_qos, prefetch_count=self._prefetch_count)
+        self._channel = channel
+        for queue_name in self.bindings:
+            channel.basic_consume(queue_name, self._on_message)
+        self.logger.info('Consuming %s with prefetch %d', list(self.bindings), self._prefetch_count)
+
+    def _on_message(self, channel, basic_deliver, properties, body) -> None:
+        self._queue.put_nowait(AsyncMessage(self, channel, basic_deliver, properties, body))
+
+    def _on_channel_closed(self, channel, reason) -> None:
+        self.logger.warning('Channel %i was closed: %s', channel, reason)
+        self._channel = None
+        self._fail_pending(reason if isinstance(reason, Exception) else AMQPError(reason))
+        if self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def _on_connection_closed(self, _unused_connection, reason) -> None:
+        self._channel = None
+        self._fail_pending(reason if isinstance(reason, Exception) else AMQPError(reason))
+        if not self._closing and self._reconnect_task is None:
+            self.logger.warning('Connection closed, reconnecting: %s', reason)
+            assert self._loop is not None
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = 0.5
+        try:
+            while not self._closing:
+                await asyncio.sleep(delay)
+                try:
+                    await self._setup()
+                    return
+                except (AMQPError, OSError) as e:
+                    self.logger.warning('Reconnect failed: %s', e)
+                    delay = min(self._RECONNECT_DELAY_MAX, delay * 2)
+        finally:
+            self._reconnect_task = None
+
+
 class NoLogInterface(object):
     def info(self, *args, **kwargs):
         pass
@@ -499,7 +772,182 @@ class NoLogInterface(object):
         pass
 
 
+class PikaPublisher(object):
+    """
+    Thread-safe publisher with a long-lived connection and channel, owned by its own thread.
+
+    `publish` only puts the message into a bounded buffer. The publisher thread drains
+    the buffer in batches, declares each exchange once per channel and reconnects with
+    backoff if the connection is lost, keeping the unsent batch.
+    With `confirm`, each batch is published in a channel transaction and committed at once,
+    so the broker acknowledges a whole batch instead of every message.
+    With `durable`, the exchanges are declared durable; messages survive a broker restart
+    only if they are also published with `delivery_mode=2` properties.
+    Delivery is at least once: a batch interrupted by a connection loss is sent again.
+    """
+    _RECONNECT_DELAY_MAX = 30.
+
+    def __init__(
+        self,
+        parameters: Optional[ConnectionParameters] = None,
+        max_buffer: int = 10000,
+        batch_size: int = 100,
+        confirm: bool = False,
+        logging_interface_obj: Any = None,
+        durable: bool = False,
+    ):
+        self._parameters = parameters if parameters is not None else ConnectionParameters(heartbeat=60)
+        self._queue: queue.Queue[Optional[Tuple[Optional[str], str, Union[str, bytes], Optional["BasicProperties"]]]] = queue.Queue(max_buffer)
+        self._batch_size = batch_size
+        self._confirm = confirm
+        self._durable = durable
+        self._connection: Optional[BlockingConnection] = None
+        self._channel: Any = None
+        self._declared: Set[str] = set()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self.logger = logging_interface_obj if logging_interface_obj is not None else NoLogInterface()
+        self.published = 0
+        self.dropped = 0
+
+    def start(self) -> "PikaPublisher":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pika-publisher", daemon=True)
+            self._thread.start()
+        return self
+
+    def publish(
+        self,
+        routing_key: str,
+        message: Union[str, bytes],
+        exchange: Optional[str] = None,
+        properties: Optional["BasicProperties"] = None,
+        block: bool = False,
+        timeout: Optional[float] = None,
+    ) -> bool:
+        """
+        Queue a message. The exchange defaults to `routing_key.split('.')[0]`,
+        use `exchange=""` for the default exchange.
+        Return False if the buffer is full.
+        """
+        try:
+            self._queue.put((exchange, routing_key, message, properties), block, timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 5.) -> bool:
+        """
+        Wait until the buffer is drained. Return False on timeout.
+        """
+        end = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= end:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def stop(self, timeout: float = 5.) -> None:
+        self._stopped = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            ...
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _ensure_channel(self):
+        if self._channel is None or not self._channel.is_open:
+            if self._connection is None or not self._connection.is_open:
+                self._connection = BlockingConnection(self._parameters)
+            self._channel = self._connection.channel()
+            if self._confirm:
+                self._channel.tx_select()
+            self._declared.clear()
+        return self._channel
+
+    def _close(self) -> None:
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except AMQPError:
+            ...
+        self._connection = None
+        self._channel = None
+
+    def _publish_batch(self, batch: List[Tuple[Optional[str], str, Union[str, bytes], Optional["BasicProperties"]]]) -> None:
+        channel = self._ensure_channel()
+        for exchange, routing_key, message, properties in batch:
+            if exchange is None:
+                exchange = routing_key.split('.')[0]
+            if exchange and exchange not in self._declared:
+                channel.exchange_declare(exchange=exchange, exchange_type=ExchangeType.topic, durable=self._durable)
+                self._declared.add(exchange)
+            channel.basic_publish(exchange=exchange, routing_key=routing_key, body=message, properties=properties)
+        if self._confirm:
+            channel.tx_commit()
+
+    def _next_batch(self, timeout: float):
+        first = self._queue.get(timeout=timeout)
+        batch = [first]
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        delay = 0.
+        batch: list = []
+        stop_seen = False
+        while True:
+            if not batch:
+                if stop_seen:
+                    break
+                try:
+                    batch = self._next_batch(timeout=1.)
+                except queue.Empty:
+                    if self._connection is not None and self._connection.is_open:
+                        # keep heartbeats going while idle
+                        self._connection.process_data_events(0)
+                    continue
+                if None in batch:
+                    stop_seen = True
+                    for _ in range(batch.count(None)):
+                        self._queue.task_done()
+                    batch = [x for x in batch if x is not None]
+                    continue
+            try:
+                self._publish_batch(batch)
+            except (AMQPError, OSError) as e:
+                self.logger.warning('Publish failed, reconnecting: %s', e)
+                self._close()
+                if self._stopped:
+                    self.dropped += len(batch)
+                    for _ in batch:
+                        self._queue.task_done()
+                    batch = []
+                    continue
+                delay = min(self._RECONNECT_DELAY_MAX, max(0.1, delay * 2))
+                time.sleep(delay)
+                continue
+            delay = 0.
+            self.published += len(batch)
+            for _ in batch:
+                self._queue.task_done()
+            batch = []
+        self._close()
+
+
 class PikaMessageQueue(object):
+    _BATCH_SIZE = 100
+
     def __init__(self) -> None:
         self._queue: queue.Queue[Tuple[str, str]] = queue.Queue()
         self._stopped = False
@@ -510,11 +958,18 @@ class PikaMessageQueue(object):
     def run(self) -> None:
         while not self._stopped:
             try:
-                routing_key, message = self._queue.get(block=True, timeout=0.5)
+                batch = [self._queue.get(block=True, timeout=0.5)]
             except queue.Empty:
                 continue  # maybe false awakened by self.stop()
+            while len(batch) < self._BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
             if not self._stopped:
-                send_message(routing_key, message, get_substained_connection())
+                connection = get_substained_connection()
+                for routing_key, message in batch:
+                    send_message(routing_key, message, connection)
         with self._queue.not_full:
             self._queue.not_full.notify()  # wake the caller thread of self.stop()
 
@@ -0,0 +1,179 @@
+"""
+Admin-triggered profiling of the running server.
+"sample" mode samples the stacks of all threads for a window and writes flamegraph
+collapsed stacks, "cprofile" mode runs a fraction of `/api` calls under cProfile
+and writes a pstats file. Both write to `<data folder>/profiles`.
+Outside a profiling window, `maybe_profile()` returns a shared no-op context.
+"""
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Any, Dict, List, Optional
+
+from openai_session_logging import log
+
+_NULL = nullcontext()
+_lock = threading.Lock()
+_current: Optional["_Session"] = None
+_last: Optional[Dict[str, Any]] = None
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Session(object):
+    def __init__(self, mode: str, seconds: float, path: str) -> None:
+        self.mode = mode
+        self.seconds = seconds
+        self.path = path
+        self.started = monotonic()
+        self.samples = 0
+        self.written = False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "seconds": self.seconds,
+            "elapsed": round(monotonic() - self.started, 3),
+            "samples": self.samples,
+        }
+
+
+class _Sampler(_Session):
+    def __init__(self, seconds: float, path: str, interval: float) -> None:
+        super().__init__("sample", seconds, path)
+        self.interval = interval
+        self._stacks: Dict[str, int] = {}
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        end = self.started + self.seconds
+        while monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                f = frame
+                while f is not None:
+                    stack.append(_frame_label(f.f_code))
+                    f = f.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+            sleep(self.interval)
+        with open(self.path, "w", encoding="utf-8") as f:
+            for key, count in self._stacks.items():
+                f.write(f"{key} {count}\n")
+        self.written = True
+        _finish(self)
+
+
+class _RequestProfiler(_Session):
+    def __init__(self, seconds: float, path: str, fraction: float) -> None:
+        super().__init__("cprofile", seconds, path)
+        self.fraction = fraction
+        self._stats: Optional[pstats.Stats] = None
+        # cProfile cannot profile two threads at once, extra requests are skipped
+        self._busy = threading.Lock()
+        self._closed = False
+
+    def run(self) -> None:
+        sleep(self.seconds)
+        with self._busy:
+            self._closed = True
+            if self._stats is not None:
+                self._stats.dump_stats(self.path)
+                self.written = True
+        _finish(self)
+
+    def maybe_profile(self):
+        if random.random() >= self.fraction or not self._busy.acquire(False):
+            return _NULL
+        if self._closed:
+            self._busy.release()
+            return _NULL
+        return self
+
+    def __enter__(self) -> None:
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def __exit__(self, *args) -> None:
+        try:
+            self._profile.disable()
+            if self._stats is None:
+                self._stats = pstats.Stats(self._profile)
+            else:
+                self._stats.add(self._profile)
+            self.samples += 1
+        finally:
+            self._busy.release()
+
+
+def _finish(session: _Session) -> None:
+    global _current, _last
+    with _lock:
+        _current = None
+        _last = session.status()
+        if not session.written:
+            # no request was sampled during a cprofile window
+            _last["path"] = None
+    if session.written:
+        log(f"Profile written to {session.path} ({session.samples} samples)")
+    else:
+        log("Profile window ended without samples, no file written")
+
+
+def start(directory: str, mode: str, seconds: float, interval: float = 0.01, fraction: float = 1.) -> Dict[str, Any]:
+    """
+    Start a profiling window, raise RuntimeError if one is already running.
+    """
+    global _current
+    if mode not in ("sample", "cprofile"):
+        raise ValueError(f"Unknown profiling mode: {mode}")
+    if seconds <= 0 or interval <= 0:
+        raise ValueError("seconds and interval must be positive")
+    folder = os.path.join(directory, "profiles")
+    os.makedirs(folder, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    with _lock:
+        if _current is not None:
+            raise RuntimeError("A profile is already running")
+        if mode == "sample":
+            session: _Session = _Sampler(seconds, os.path.join(folder, f"profile-{stamp}.collapsed"), interval)
+        else:
+            session = _RequestProfiler(seconds, os.path.join(folder, f"profile-{stamp}.pstats"), fraction)
+        _current = session
+    threading.Thread(target=session.run, name="profiler", daemon=True).start()  # type: ignore
+    return session.status()
+
+
+def maybe_profile():
+    """
+    Context for an `/api` call, profiles it if a cprofile window is open and the call is sampled.
+    """
+    session = _current
+    if session is None or not isinstance(session, _RequestProfiler):
+        return _NULL
+    return session.maybe_profile()
+
+
+def status(directory: str) -> Dict[str, Any]:
+    folder = os.path.join(directory, "profiles")
+    files: List[str] = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+    with _lock:
+        return {
+            "running": _current.status() if _current is not None else None,
+            "last": _last,
+            "files": files,
+        }
@@ -0,0 +1,159 @@
+"""
+Change data capture for the session store.
+
+A primary with a `ChangeEmitter` publishes every persisted node creation or update
+to the topic exchange `openai_session_cdc`. A `SessionReplica` applies those events
+to its own `SessionKeeper`, so a warm replica can be promoted to primary at once
+instead of loading the whole data folder after a failure.
+"""
+import json
+import os
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple
+
+import metrics
+from lock_stats import make_lock
+from openai_session import SessionData, SessionKeeper
+from openai_session_logging import WARNING, log
+
+if TYPE_CHECKING:
+    from pika import BasicProperties
+    from pika.spec import Basic
+
+CDC_EXCHANGE = "openai_session_cdc"
+CDC_ROUTING_KEY = f"{CDC_EXCHANGE}.upsert"
+# how long a change waits for room in the publisher buffer before it is dropped
+CDC_PUBLISH_TIMEOUT = float(os.environ.get("OPENAI_CDC_PUBLISH_TIMEOUT", "5"))
+
+CDC_DROPPED_TOTAL = metrics.Counter("openai_session_cdc_dropped_total", "Change events dropped by the primary.")
+CDC_MISSED_TOTAL = metrics.Counter("openai_session_cdc_missed_total", "Change events a replica never received.")
+
+
+class ChangeEmitter(object):
+    """
+    `SessionKeeper.change_listener` publishing compact change events.
+    Events are persistent messages on a durable exchange, so that a broker restart keeps
+    the ones already routed to replica queues. A full buffer blocks the caller for at most
+    `CDC_PUBLISH_TIMEOUT` seconds before the event is dropped; every event carries the
+    `origin` of the emitter and a `seq` number in its headers, so a replica can tell.
+    """
+
+    def __init__(self, publisher: Any = None) -> None:
+        import pika
+        if publisher is None:
+            import pika_interface_blocking
+            publisher = pika_interface_blocking.PikaPublisher(durable=True).start()
+        self._publisher = publisher
+        self._properties_type = pika.BasicProperties
+        self._origin = os.urandom(8).hex()
+        self._seq = 0
+        # events are numbered and buffered in the same order
+        self._lock = make_lock("cdc")
+
+    def __call__(self, data: SessionData) -> None:
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._seq += 1
+            properties = self._properties_type(delivery_mode=2, headers={"origin": self._origin, "seq": self._seq})
+            sent = self._publisher.publish(CDC_ROUTING_KEY, body, properties=properties, block=True, timeout=CDC_PUBLISH_TIMEOUT)
+        if not sent:
+            CDC_DROPPED_TOTAL.inc()
+            log(f"CDC buffer full, change of sid {data.id} dropped", level=WARNING)
+
+    def stop(self) -> None:
+        self._publisher.stop()
+
+
+class SessionReplica(object):
+    """
+    Keep a `SessionKeeper` warm from the change stream.
+
+    The replica queue is durable and declared before the snapshot in the data folder is
+    loaded, events received meanwhile are buffered and applied in order afterwards.
+    Applying an event again is harmless, so the keeper converges to the primary state.
+    An event that cannot be parsed or applied is logged and skipped. Gaps in the `seq` numbers
+    of the current emitter are counted in `missed`, such a replica should not be promoted.
+    """
+    _CONSUMING_TIMEOUT = 30.
+
+    def __init__(self, data_directory: str, name: str) -> None:
+        self.data_directory = data_directory
+        self.queue_name = f"{CDC_EXCHANGE}.replica.{name}"
+        self._lock = make_lock("replica")
+        self._buffer: List[SessionData] = []
+        self._keeper: Optional[SessionKeeper] = None
+        self._consumer: Any = None
+        self._last: Optional[Tuple[str, int]] = None
+        self.missed = 0
+
+    def start(self, **keeper_kwargs) -> SessionKeeper:
+        import pika_interface_blocking
+        self._consumer = pika_interface_blocking.listen_to(
+            CDC_EXCHANGE,
+            {self.queue_name: f"{CDC_EXCHANGE}.#"},
+            self._on_change,
+            logging_interface_obj=pika_interface_blocking.NoLogInterface(),
+            prefetch_count=100,
+            durable=True,
+        )
+        end = monotonic() + self._CONSUMING_TIMEOUT
+        while not self._consumer.was_consuming:
+            if monotonic() >= end:
+                raise RuntimeError("Replica could not subscribe to the change stream")
+            sleep(0.05)
+        keeper = SessionKeeper(self.data_directory, **keeper_kwargs)
+        with self._lock:
+            for data in self._buffer:
+                self._apply(keeper, data)
+            log(f"Replica caught up, {len(self._buffer)} buffered changes applied")
+            self._buffer = []
+            self._keeper = keeper
+        return keeper
+
+    def _on_change(self, routing_key: str, body: bytes, deliver: "Basic.Deliver", properties: "BasicProperties") -> None:
+        # callbacks run on the consumer ioloop, an exception there would stop consuming
+        try:
+            data = SessionData.from_dict(json.loads(body))
+        except (ValueError, TypeError) as e:
+            log(f"Replica skipped a malformed change event: {e!r}", level=WARNING)
+            return
+        with self._lock:
+            self._check_sequence(properties)
+            if self._keeper is None:
+                self._buffer.append(data)
+                return
+            self._apply(self._keeper, data)
+
+    def _check_sequence(self, properties: "BasicProperties") -> None:
+        headers = properties.headers or {}
+        origin, seq = headers.get("origin"), headers.get("seq")
+        if not isinstance(seq, int):
+            return
+        if self._last is not None and self._last[0] == origin:
+            if seq <= self._last[1]:
+                # redelivery, applying it again is harmless
+                return
+            gap = seq - self._last[1] - 1
+            if gap:
+                self.missed += gap
+                CDC_MISSED_TOTAL.inc(amount=gap)
+                log(f"Replica missed {gap} change events before seq {seq}", level=WARNING)
+        self._last = (origin, seq)
+
+    @staticmethod
+    def _apply(keeper: SessionKeeper, data: SessionData) -> None:
+        try:
+            keeper.apply_change(data)
+        except Exception as e:
+            log(f"Replica skipped the change of sid {data.id}: {e!r}", level=WARNING)
+
+    def promote(self) -> SessionKeeper:
+        """
+        Stop following the primary and start emitting changes as the new primary.
+        """
+        if self._keeper is None:
+            raise RuntimeError("Replica has not caught up yet")
+        self._consumer.stop()
+        self._keeper.change_listener = ChangeEmitter()
+        log("Replica promoted to primary")
+        return self._keeper
@@ -0,0 +1,253 @@
+"""
+Bulk export and import of sessions as gzip compressed NDJSON, one node per line,
+parents before their children.
+
+    python session_export.py export "$OPENAI_DATA_FOLDER" sessions.ndjson.gz [--root SID ...] [--since UNIX_TIME]
+    python session_export.py import "$OPENAI_DATA_FOLDER" sessions.ndjson.gz
+
+The CLI works on the files of a data folder of a stopped server, without loading
+it into a `SessionKeeper`; the running server exposes the same operations as
+`/admin/export` and `/admin/import`.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import zlib
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional
+
+from openai_session import SessionData, SessionKeeper
+
+# bytes handed out at once by the export stream
+_CHUNK = 1 << 16
+
+
+def _node_path(directory: str, sid: int) -> str:
+    return os.path.join(directory, f"s_{sid}.json")
+
+
+def _walk(
+    directory: str,
+    links: Iterable[tuple[int, Optional[int]]],
+    get: Callable[[int], Optional[SessionData]],
+    roots: Optional[List[int]],
+    since: Optional[float],
+) -> Iterator[SessionData]:
+    all_roots = []
+    children: Dict[int, List[int]] = {}
+    for sid, previous in links:
+        if previous is None:
+            all_roots.append(sid)
+        else:
+            children.setdefault(previous, []).append(sid)
+    # with `since`, ancestors are exported with their changed descendants, so that
+    # the stream also imports into a host that does not have them
+    exported: set[int] = set()
+    stack = list(reversed(roots if roots is not None else all_roots))
+    while stack:
+        data = get(stack.pop())
+        if data is None:
+            continue
+        stack.extend(children.get(data.id, ()))
+        if since is None:
+            yield data
+            continue
+        try:
+            if os.path.getmtime(_node_path(directory, data.id)) < since:
+                continue
+        except OSError:
+            continue
+        ancestors = []
+        previous = data.previous
+        while previous is not None and previous not in exported:
+            parent = get(previous)
+            if parent is None:
+                break
+            ancestors.append(parent)
+            previous = parent.previous
+        for x in reversed(ancestors):
+            exported.add(x.id)
+            yield x
+        exported.add(data.id)
+        yield data
+
+
+def iter_nodes(keeper: SessionKeeper, roots: Optional[List[int]] = None, since: Optional[float] = None) -> Iterator[SessionData]:
+    """
+    Nodes of the given trees (all trees by default), parents first.
+    With `since`, only nodes whose file was modified at or after that unix time, and their ancestors.
+    A children map of all ids is held in memory, plus the exported ids with `since`.
+    """
+    def _get(sid: int) -> Optional[SessionData]:
+        t = keeper.get(sid)
+        return None if t is None else t.data
+    links = [(t.data.id, t.data.previous) for t in keeper.values()]
+    return _walk(keeper.data_directory, links, _get, roots, since)
+
+
+def _read_node(directory: str, sid: int) -> Optional[SessionData]:
+    try:
+        with open(_node_path(directory, sid), "r", encoding="utf-8") as f:
+            return SessionData.deserialize(f)
+    except OSError:
+        return None
+
+
+def _node_ids(directory: str) -> Iterator[int]:
+    for x in os.listdir(directory):
+        if x.startswith("s_") and x.endswith(".json") and x[2:-5].isdigit():
+            yield int(x[2:-5])
+
+
+def iter_folder_nodes(directory: str, roots: Optional[List[int]] = None, since: Optional[float] = None) -> Iterator[SessionData]:
+    """
+    `iter_nodes` over the `s_*.json` files of a data folder, without loading it into a `SessionKeeper`.
+    Every file is read once for the index and again when its node is yielded.
+    """
+    def _links() -> Iterator[tuple[int, Optional[int]]]:
+        for sid in _node_ids(directory):
+            data = _read_node(directory, sid)
+            if data is not None:
+                yield data.id, data.previous
+    return _walk(directory, _links(), lambda sid: _read_node(directory, sid), roots, since)
+
+
+class _FolderStore(object):
+    """
+    The part of `SessionKeeper` used by `import_stream`, writing to the files of a data folder.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        # existing ids are taken from the file names, the files are not read
+        self._ids = set(_node_ids(directory))
+
+    def has(self, sid: int) -> bool:
+        return sid in self._ids
+
+    def insert_batch(self, batch: List[SessionData]) -> int:
+        n = 0
+        for data in batch:
+            if data.id in self._ids:
+                continue
+            with open(_node_path(self.directory, data.id), "w", encoding="utf-8") as f:
+                f.write(data.serialize())
+            self._ids.add(data.id)
+            n += 1
+        return n
+
+
+def iter_export(nodes: Iterable[SessionData]) -> Iterator[bytes]:
+    """
+    Gzip compressed NDJSON of `nodes`, in chunks of about `_CHUNK` bytes.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buffer: List[bytes] = []
+    size = 0
+    for data in nodes:
+        out = compressor.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode() + b"\n")
+        if out:
+            buffer.append(out)
+            size += len(out)
+            if size >= _CHUNK:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+    buffer.append(compressor.flush())
+    yield b"".join(buffer)
+
+
+def _validate(o: Any) -> SessionData:
+    if not isinstance(o, dict) or not isinstance(o.get("id"), int) or not isinstance(o.get("user_message"), str):
+        raise ValueError("not a session node")
+    data = SessionData.from_dict(o)
+    if (data.previous is None) == (data.system_msg is None):
+        raise ValueError(f"node {data.id}: exactly one of previous and system_msg must be set")
+    return data
+
+
+def import_stream(keeper: "SessionKeeper | _FolderStore", stream: BinaryIO, batch_size: int = 1000) -> Dict[str, Any]:
+    """
+    Import gzip compressed NDJSON nodes into `keeper`.
+    A node is inserted once its parent exists, nodes arriving before their parent wait
+    for it, so a stream in export order is imported in constant memory. Nodes whose
+    parent never shows up are rejected, existing ids are skipped.
+    """
+    report: Dict[str, Any] = {"imported": 0, "skipped_existing": 0, "rejected": 0, "errors": []}
+    # ids inserted or queued in the current batch
+    accepted: set[int] = set()
+    waiting: Dict[int, List[SessionData]] = {}
+    batch: List[SessionData] = []
+
+    def _flush() -> None:
+        report["imported"] += keeper.insert_batch(batch)
+        batch.clear()
+        accepted.clear()
+
+    def _reject(reason: str) -> None:
+        report["rejected"] += 1
+        if len(report["errors"]) < 100:
+            report["errors"].append(reason)
+
+    def _accept(data: SessionData) -> None:
+        ready = [data]
+        while ready:
+            x = ready.pop()
+            batch.append(x)
+            accepted.add(x.id)
+            ready.extend(waiting.pop(x.id, ()))
+        if len(batch) >= batch_size:
+            _flush()
+
+    with gzip.open(stream, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                data = _validate(json.loads(line))
+            except (ValueError, TypeError) as e:
+                _reject(f"line {line_number}: {e}")
+                continue
+            if keeper.has(data.id) or data.id in accepted:
+                report["skipped_existing"] += 1
+                continue
+            if data.previous is None or keeper.has(data.previous) or data.previous in accepted:
+                _accept(data)
+            else:
+                waiting.setdefault(data.previous, []).append(data)
+    _flush()
+    for previous, nodes in waiting.items():
+        for data in nodes:
+            _reject(f"node {data.id}: parent {previous} not found")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export")
+    export_parser.add_argument("data_directory")
+    export_parser.add_argument("output", help="file to write, - for stdout")
+    export_parser.add_argument("--root", type=int, action="append", default=None, help="export this tree only, repeatable")
+    export_parser.add_argument("--since", type=float, default=None, help="only nodes modified since this unix time")
+    import_parser = sub.add_parser("import")
+    import_parser.add_argument("data_directory")
+    import_parser.add_argument("input", help="file to read, - for stdin")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        with out:
+            for chunk in iter_export(iter_folder_nodes(args.data_directory, args.root, args.since)):
+                out.write(chunk)
+    else:
+        source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+        with source:
+            report = import_stream(_FolderStore(args.data_directory), source, args.batch_size)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
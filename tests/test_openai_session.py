@@ -0,0 +1,129 @@
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+
+import openai_session  # noqa: E402
+from api_call import CompletionAPIResponse  # noqa: E402
+from openai_session import OpenAISession, SessionData, SessionKeeper  # noqa: E402
+
+# one token per word, a message of `_WORDS` words
+_WORDS = 10
+
+
+class _WordEncoding(object):
+    @staticmethod
+    def encode(text, **kw):
+        return text.split()
+
+    def encode_batch(self, texts, **kw):
+        return [self.encode(x) for x in texts]
+
+
+def _text(i: int) -> str:
+    return " ".join(f"m{i}w{j}" for j in range(_WORDS))
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Record the system message and history of every upstream call.
+    """
+    calls = []
+
+    def _call(system_msg, messages, model, *args, **kw):
+        calls.append((system_msg, list(messages)))
+        return CompletionAPIResponse(role="assistant", content=_text(100 + len(calls)), reasoning_content=None, cached_tokens=None)
+
+    monkeypatch.setattr(openai_session, "completion_api_call", _call)
+    monkeypatch.setattr(openai_session, "encoding_for", lambda model: _WordEncoding())
+    monkeypatch.setattr(openai_session, "log", lambda *args, **kw: None)
+    monkeypatch.setattr(OpenAISession, "_get_token_max", staticmethod(lambda model: 100))
+    return calls
+
+
+def _chain(keeper: SessionKeeper, nodes: int) -> int:
+    """
+    Create and save a chain of answered nodes, return the sid of the last one.
+    """
+    keeper.create(1, "sys", None, _text(0), _text(1))
+    for sid in range(2, nodes + 1):
+        keeper.create(sid, None, sid - 1, _text(2 * sid), _text(2 * sid + 1))
+    keeper.save()
+    return nodes
+
+
+def test_fields_read_back_from_the_dict(tmp_path):
+    data = SessionData.from_dict({"id": 1, "system_msg": "sys", "previous": None, "user_message": "u",
+                                  "assistant_message": "a", "user_name": None, "assistant_name": None})
+    data.history_cut = 4
+    assert data.history_cut == 4
+    assert data["history_cut"] == 4
+
+
+def test_chunked_policy_keeps_the_previous_cut(tmp_path, monkeypatch, sent):
+    monkeypatch.setattr(openai_session, "TRUNCATION_POLICY", "chunked")
+    monkeypatch.setattr(openai_session, "TRUNCATION_CHUNK", 2)
+    monkeypatch.setattr(openai_session, "TRUNCATION_LOW_WATER", 0.5)
+    keeper = SessionKeeper(str(tmp_path))
+    sid = _chain(keeper, 10)
+    # 21 messages of 10 tokens overflow the limit of 100, the cut drops to the low water mark
+    first = keeper.call(sid, _text(50), openai_session.GPT3_5, None)
+    cut = keeper.get(first.new_session_id).data.history_cut
+    assert cut == 18
+    assert len(sent[0][1]) == 21 - cut
+    # still over the limit from the start, but the history after the cut fits
+    keeper.call(first.new_session_id, _text(51), openai_session.GPT3_5, None)
+    assert len(sent[1][1]) == 23 - cut
+    assert sent[1][1][0] == sent[0][1][0]
+
+
+def test_compacted_chain_sends_the_summary(tmp_path, monkeypatch, sent):
+    monkeypatch.setattr(OpenAISession, "_get_token_max", staticmethod(lambda model: 1000))
+    monkeypatch.setattr(openai_session, "COMPACTION_KEEP", 0.02)
+    keeper = SessionKeeper(str(tmp_path))
+    sid = _chain(keeper, 5)
+    node = keeper.get(sid)
+    chain = node.get_chain()
+    history = OpenAISession.parse_history(chain)
+    node._compact(chain, openai_session.ModelWrapper(openai_session.GPT3_5))
+    summary = sent[0][1][0]["content"]
+    assert history[7]["content"] in summary and history[8]["content"] not in summary
+    # read back from the saved file, like after a restart
+    reloaded = SessionKeeper(str(tmp_path))
+    assert reloaded.get(sid).data.summary_upto == 8
+    reloaded.call(sid, _text(50), openai_session.GPT3_5, None)
+    system_msg, messages = sent[1]
+    assert system_msg.startswith("sys") and system_msg.endswith(_text(101))
+    assert messages == history[8:] + [{"role": "user", "content": _text(50)}]
+
+
+def test_compaction_transcript_fits_the_summarizer(tmp_path, monkeypatch, sent):
+    monkeypatch.setattr(OpenAISession, "_get_token_max", staticmethod(lambda model: 200))
+    monkeypatch.setattr(openai_session, "COMPACTION_KEEP", 0.1)
+    keeper = SessionKeeper(str(tmp_path))
+    sid = _chain(keeper, 5)
+    node = keeper.get(sid)
+    chain = node.get_chain()
+    history = OpenAISession.parse_history(chain)
+    node._compact(chain, openai_session.ModelWrapper(openai_session.GPT3_5))
+    # half of the window minus the prompt leaves room for 7 messages, cut to whole turns
+    assert node.data.summary_upto == 6
+    transcript = sent[0][1][0]["content"]
+    assert history[5]["content"] in transcript and history[6]["content"] not in transcript
+
+
+@pytest.mark.parametrize("policy", ["sliding", "chunked"])
+def test_project_matches_the_call_and_encodes_once(tmp_path, monkeypatch, sent, policy):
+    monkeypatch.setattr(openai_session, "TRUNCATION_POLICY", policy)
+    keeper = SessionKeeper(str(tmp_path))
+    node = keeper.get(_chain(keeper, 10))
+
+    def _single(*args):
+        raise AssertionError("counted one message at a time")
+    with monkeypatch.context() as m:
+        m.setattr(OpenAISession, "_count_token_for", staticmethod(_single))
+        projection = node.project(_text(50), openai_session.GPT3_5)
+    result = node.call(_text(50), openai_session.GPT3_5)
+    assert projection["cut_index"] == keeper.get(result.new_session_id).data.history_cut
+    assert projection["token_used"] == result.token_in
@@ -0,0 +1,157 @@
+"""
+Lightweight per-request spans.
+A trace is bound to the handling thread through a context variable, so `span()`
+is a cheap no-op outside of a traced request (e.g. in background compaction).
+"""
+import json
+import os
+import random
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter, time_ns
+from typing import Any, Dict, List, Optional
+
+# fraction of traces exported, tracing itself is always on for Server-Timing
+SAMPLE_RATE = float(os.environ.get("OPENAI_TRACE_SAMPLE", "0"))
+# "log" publishes to the logging exchange, anything else is a JSON lines file path
+EXPORT = os.environ.get("OPENAI_TRACE_EXPORT", "log")
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("openai_session_trace", default=None)
+_export_lock = Lock()
+
+
+class Trace(object):
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.trace_id = os.urandom(16).hex()
+        self.start_unix_ns = time_ns()
+        self.start = perf_counter()
+        self.end: float | None = None
+        # (name, 1-based index of the parent span or 0 for the root, start, end)
+        self.spans: List[tuple[str, int, float, float]] = []
+        self._stack: List[int] = []
+        self._token = None
+
+    def elapsed(self) -> float:
+        return (self.end if self.end is not None else perf_counter()) - self.start
+
+    def timings(self) -> Dict[str, float]:
+        """
+        Milliseconds per span name, repeated spans are summed.
+        """
+        ret: Dict[str, float] = {}
+        for name, _, start, end in self.spans:
+            ret[name] = ret.get(name, 0.) + (end - start) * 1000
+        ret["total"] = self.elapsed() * 1000
+        return {k: round(v, 3) for k, v in ret.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{k};dur={v}" for k, v in self.timings().items())
+
+    def to_json(self, max_spans: Optional[int] = None) -> Dict[str, Any]:
+        """
+        OTLP-like span list: ids are hex, times are unix nanoseconds.
+        Only the first `max_spans` spans are kept if given, parents start before their children
+        so the kept ones stay linked, and the root span counts the others in `dropped_spans`.
+        """
+        def _ns(t: float) -> int:
+            return self.start_unix_ns + int((t - self.start) * 1e9)
+        root_id = self.trace_id[:16]
+        spans = [{
+            "traceId": self.trace_id,
+            "spanId": root_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_unix_ns,
+            "endTimeUnixNano": _ns(self.start + self.elapsed()),
+        }]
+        kept = self.spans if max_spans is None else self.spans[:max_spans]
+        if len(kept) < len(self.spans):
+            spans[0]["attributes"] = [{"key": "dropped_spans", "value": {"intValue": len(self.spans) - len(kept)}}]
+        ids = [f"{i + 1:016x}" for i in range(len(kept))]
+        for i, (name, parent, start, end) in enumerate(kept):
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": ids[i],
+                "parentSpanId": ids[parent - 1] if parent else root_id,
+                "name": name,
+                "startTimeUnixNano": _ns(start),
+                "endTimeUnixNano": _ns(end),
+            })
+        return {"resourceSpans": [{"scopeSpans": [{"spans": spans}]}]}
+
+
+class _Span(object):
+    __slots__ = ("name", "trace", "start", "parent")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.trace = _current.get()
+
+    def __enter__(self) -> "_Span":
+        trace = self.trace
+        if trace is not None:
+            self.parent = trace._stack[-1] if trace._stack else 0
+            trace.spans.append((self.name, self.parent, 0., 0.))
+            trace._stack.append(len(trace.spans))
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        trace = self.trace
+        if trace is not None:
+            index = trace._stack.pop()
+            trace.spans[index - 1] = (self.name, self.parent, self.start, perf_counter())
+
+
+def span(name: str) -> _Span:
+    """
+    Time a block as a span of the current trace, if any.
+    """
+    return _Span(name)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def start(name: str) -> Trace:
+    trace = Trace(name)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def finish(trace: Trace) -> None:
+    """
+    Close the trace and export it if sampled. Calling it twice is harmless.
+    """
+    if trace.end is not None:
+        return
+    trace.end = perf_counter()
+    if trace._token is not None:
+        _current.reset(trace._token)
+        trace._token = None
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        _export(trace)
+
+
+def _export(trace: Trace) -> None:
+    line = json.dumps(trace.to_json(), separators=(",", ":"))
+    if EXPORT == "log":
+        # imported here, the logging module is itself traced
+        from openai_session_logging import MAX_PAYLOAD, log
+        # drop spans rather than let the log truncation cut the JSON
+        max_spans = len(trace.spans)
+        while len(line) > MAX_PAYLOAD and max_spans > 0:
+            max_spans = min(max_spans - 1, max_spans * MAX_PAYLOAD // len(line))
+            line = json.dumps(trace.to_json(max_spans), separators=(",", ":"))
+        if len(line) > MAX_PAYLOAD:
+            print(f"[tracing] trace {trace.trace_id} does not fit OPENAI_LOG_MAX_PAYLOAD, not exported")
+            return
+        log(line, key="trace")
+        return
+    try:
+        with _export_lock, open(EXPORT, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.write("\n")
+    except OSError as e:
+        print(e)
@@ -0,0 +1,102 @@
+"""
+Startup warmup, so that the first requests do not pay for lazy initialization.
+Each step is timed into a report served by `/ready`; a failing step is recorded
+and does not stop the others, the server then runs with lazy initialization.
+"""
+import os
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+from model_wrap import TIKTOKEN_NAME_DICT, ModelWrapper
+from openai_session_logging import WARNING, log
+
+# seconds to wait for each step that depends on the network
+WARMUP_TIMEOUT = float(os.environ.get("OPENAI_WARMUP_TIMEOUT", "10"))
+
+
+def _wait_for(f: Callable[[], None], what: str) -> None:
+    """
+    Run `f` in a daemon thread, raise if it fails or does not finish in `WARMUP_TIMEOUT`.
+    A late `f` keeps running and still fills its cache.
+    """
+    errors: List[BaseException] = []
+    done = threading.Event()
+
+    def _run() -> None:
+        try:
+            f()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            done.set()
+    threading.Thread(target=_run, name=f"warmup-{what}", daemon=True).start()
+    if not done.wait(WARMUP_TIMEOUT):
+        raise TimeoutError(f"{what} not loaded in time")
+    if errors:
+        raise errors[0]
+
+
+class Warmup(object):
+    def __init__(self, report: Dict[str, Any] | None = None) -> None:
+        # seconds per step, steps done before the warmup (imports, loading sessions) can be passed in
+        self.report: Dict[str, Any] = dict(report or {})
+        self.errors: Dict[str, str] = {}
+        self.ready = threading.Event()
+
+    def _step(self, name: str, f: Callable[[], None]) -> None:
+        t0 = perf_counter()
+        try:
+            f()
+        except Exception as e:
+            self.errors[name] = repr(e)
+            log(f"Warmup step {name} failed: {e!r}", level=WARNING)
+        self.report[name] = round(perf_counter() - t0, 4)
+
+    @staticmethod
+    def _encodings() -> None:
+        from openai_session import encoding_for
+
+        def _load() -> None:
+            # fills the per model cache, the files are read once per encoding
+            for model_id in TIKTOKEN_NAME_DICT:
+                encoding_for(ModelWrapper(model_id))
+        # tiktoken downloads missing files without a timeout
+        _wait_for(_load, "tiktoken encodings")
+
+    @staticmethod
+    def _logging() -> None:
+        from openai_session_logging import start
+        if not start().wait(WARMUP_TIMEOUT):
+            raise TimeoutError("logging transport not loaded in time")
+
+    @staticmethod
+    def _upstream() -> None:
+        from api_call import DEEPSEEK_CLIENT, OPENAI_CLIENT
+        errors: List[str] = []
+        for pool in (OPENAI_CLIENT, DEEPSEEK_CLIENT):
+            for client in pool.clients():
+                try:
+                    # resolves DNS and opens a pooled TLS connection
+                    client.with_options(timeout=WARMUP_TIMEOUT, max_retries=0).models.list()
+                except Exception as e:
+                    errors.append(f"{pool.name}: {e!r}")
+        if errors:
+            raise RuntimeError("; ".join(errors))
+
+    def run(self) -> None:
+        t0 = perf_counter()
+        self._step("tiktoken", self._encodings)
+        self._step("logging", self._logging)
+        if os.environ.get("OPENAI_WARMUP_UPSTREAM", "1") != "0":
+            self._step("upstream", self._upstream)
+        self.report["warmup"] = round(perf_counter() - t0, 4)
+        log(f"Warmup done: {self.report}")
+        self.ready.set()
+
+    def start(self) -> "Warmup":
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+        return self
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready.is_set(), "startup": self.report, "errors": self.errors}